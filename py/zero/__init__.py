@@ -7,11 +7,18 @@
 ''' Zero MQ command line interface.
 
 Usage:
-    zero [--dbg] [--wait] (pub|rep) <socket> [-c] (-|<message> [<message>...])
-    zero [--dbg] [--wait] (push|req) <socket> [-b] (-|<message> [<message>...])
-    zero [--dbg] [--wait] pull <socket> [-c] [-n MESSAGES]
-    zero [--dbg] [--wait] sub <socket> [-b] [<subscription>...] [-n MESSAGES]
+    zero [--dbg] [--wait] [--hwm N --drop] (pub|rep) <socket> [-c] (-|<message> [<message>...])
+    zero [--dbg] [--wait] [--hwm N --drop] (push|req) <socket> [-b] (-|<message> [<message>...])
+    zero [--dbg] [--wait] [--hwm N --conflate] [--where EXPR] pull <socket> [-c] [-n MESSAGES]
+    zero [--dbg] [--wait] [--hwm N --conflate] [--where EXPR] sub <socket> [-b] [<subscription>...]
+         [-n MESSAGES]
+    zero [--dbg] [--hwm N --conflate] [--where EXPR] record <file> pull <socket> [-c] [-n MESSAGES]
+    zero [--dbg] [--hwm N --conflate] [--where EXPR] record <file> sub <socket> [-b]
+         [<subscription>...] [-n MESSAGES]
+    zero [--dbg] replay <file> [--speed X | --fast] (push|pub|req) <socket> [-b|-c]
     zero [--dbg] rpc <config> <type> [<type>...]
+    zero [--dbg] scale <config> <type>
+    zero [--dbg] agent [<socket>]
     zero test [-v]
 
 Options:
@@ -21,6 +28,12 @@ Options:
     --wait          Waits for user input at the end of the program, before
                     quitting
     --dbg           Enables debug output
+    --hwm N         High water mark, the number of messages queued per peer
+    --drop          Drop messages when the queue is full instead of blocking
+    --conflate      Keep only the latest message
+    --speed X       Replay at X times the recorded pace [default: 1]
+    --fast          Replay as fast as possible
+    --where EXPR    Only messages that match the filter expression EXPR
 
 <socket> is a zmq socket or just a port, in which case the host is assumed to
 be localhost. Zmq sockets are things like tcp://*:<port> or
@@ -34,14 +47,41 @@ message is a JSON object, contained in a single line.
 
 <subscription> is any string, only messages that start with any of the
 subscriptions will be retrieved. Omit this value to subscribe to all messages.
+
+A <socket> that is just a port uses tcp, unless $ZERO_TRANSPORT says ipc,
+inproc or auto (see ZeroSetup.transport).
+
+EXPR is a filter expression (see zero.where) such as:
+    '[2] in ["wtf", "omg"] and [4] ~ "timeout"'
+    'user.age >= 18 and not user.name == "test"'
+
+zero record writes the messages it receives, with receive times, to <file>.
+zero replay sends them again at the recorded pace, --speed times faster, or as
+fast as possible, and prints the achieved rate and send latency as JSON.
+
+zero scale runs <type> from <config> as a number of worker processes, between
+"min" and "max" from its "scale" node, see zero.scale.
+
+zero agent starts a local agent that keeps sockets connected between zero
+invocations. While it runs, push, pub and req (without -) as well as pull and
+sub with -n are handed off to it. <socket> defaults to $ZERO_AGENT or
+ipc:///tmp/zero-agent-<uid>.ipc.
 '''
+import os
 import sys
 import zmq
 import json
+from time import time, sleep
+from tempfile import gettempdir
+from textwrap import wrap
 from itertools import izip
+from .stats import ZeroStats, _zeros
 
 __all__ = ('ZeroSetup', 'Zero')
 
+TRANSPORTS = ('tcp', 'ipc', 'inproc', 'auto')
+_inproc = {}  # inproc url -> zmq.Context, for endpoints bound in this process
+
 
 class UnsupportedZmqMethod(Exception):
     'Serves to signal that the method chosen for the setup was invalid.'
@@ -65,7 +105,8 @@ class ZeroSetup(object):
     def __init__(self, method, point):
         ''' Creates a setup that may be proactive (method is pub/push/req) or reactive
             (method is sub/pull/rep).
-            point -- a port number or a zmq url that is valid for the method.
+            point -- a port number or a zmq url that is valid for the method, or a list of
+                     them to bind or connect to several endpoints.
         '''
         self._method = method.lower()
         self.bind = self.method not in (zmq.SUB, zmq.PUSH, zmq.REQ)
@@ -73,6 +114,12 @@ class ZeroSetup(object):
         self._point = point
         self.linger = 1000
         self.block = True
+        self.hwm = (None, None)
+        self.conflate = False
+        self.immediate = False
+        self.drop = False
+        self.spool = None
+        self.transport(os.environ.get('ZERO_TRANSPORT', 'tcp'))
         self.output = sys.stderr
 
     @staticmethod
@@ -110,6 +157,12 @@ class ZeroSetup(object):
             setup.binding(False)
         if args['<subscription>']:
             setup.subscribing(args['<subscription>'])
+        if args['--hwm']:
+            setup.watermarks(int(args['--hwm']), int(args['--hwm']))
+        if args['--drop']:
+            setup.dropping()
+        if args['--conflate']:
+            setup.conflating()
         setup.args = args
         setup.debug('%r', setup)
 
@@ -145,6 +198,18 @@ class ZeroSetup(object):
             res.append('.debugging()')
         if not self.block:
             res.append('.nonblocking()')
+        if self._transport != 'tcp':
+            res.append('.transport(%r)' % self._transport)
+        if self.hwm != (None, None):
+            res.append('.watermarks(%r, %r)' % self.hwm)
+        if self.conflate:
+            res.append('.conflating()')
+        if self.immediate:
+            res.append('.connected()')
+        if self.drop:
+            res.append('.dropping()')
+        if self.spool:
+            res.append('.spooling(%r, %r)' % self.spool)
         if self.subscriptions:
             res.append('.subscribing(%r)' % self.subscriptions)
         return ''.join(res)
@@ -155,7 +220,6 @@ class ZeroSetup(object):
             This is currently called by debug only if debug == True, but warn and err
             call it unconditionally (though they are not used yet).
         '''
-        from textwrap import wrap
         if args:
             s = s % args
         if kwarg:
@@ -228,6 +292,119 @@ class ZeroSetup(object):
         self.block = not val
         return self
 
+    def transport(self, kind='auto'):
+        ''' Chooses the transport for a setup whose point is a port (urls are used as given).
+            tcp, ipc and inproc always use that transport. auto binds all three and connects
+            with inproc when the binding Zero is in this process, with ipc when it is on this
+            host and with tcp otherwise. Zeros with inproc or auto setups share one context.
+            The ipc socket file is how auto finds a Zero on this host, a file left behind by a
+            crashed process makes connecting Zeros wait for it to come back.
+            >>> setup = ZeroSetup('pull', 8014).transport()
+            >>> setup
+            ZeroSetup('pull', 8014).binding(True).transport('auto')
+            >>> setup.points  # doctest: +ELLIPSIS
+            ['tcp://*:8014', 'ipc://.../zero-8014.ipc', 'inproc://zero-8014']
+            >>> pull = Zero(setup)
+            >>> _ = pull.sock
+            >>> push = Zero(ZeroSetup('push', 8014).transport())
+            >>> push.setup.points
+            ['inproc://zero-8014']
+            >>> push('local')
+            >>> pull.next()
+            u'local'
+            >>> other = ZeroSetup('push', 8014).transport()
+            >>> other.ctx = zmq.Context()
+            >>> other.points  # doctest: +ELLIPSIS
+            ['ipc://.../zero-8014.ipc']
+            >>> push.close()
+            >>> pull.close()
+            >>> ZeroSetup('push', 8014).transport().points
+            ['tcp://localhost:8014']
+        '''
+        if kind not in TRANSPORTS:
+            raise ValueError('Unsupported transport %r, use one of %r' % (kind, TRANSPORTS))
+        self._transport = kind
+        return self
+
+    def watermarks(self, send=None, recv=None):
+        ''' Sets the send and receive high water marks, the number of messages queued per peer
+            before sends block (or drop, see dropping) and receives stop reading. None leaves
+            the libzmq default.
+            >>> ZeroSetup('push', 8000).watermarks(100)
+            ZeroSetup('push', 8000).binding(False).watermarks(100, None)
+        '''
+        self.hwm = (send, recv)
+        return self
+
+    def conflating(self, val=True):
+        ''' Keeps only the latest message in the queue, for latest value streams. Not for req,
+            rep or traced Zeros (conflate does not support multipart messages).
+            >>> ZeroSetup('sub', 8000).conflating()
+            ZeroSetup('sub', 8000).binding(False).conflating().subscribing([''])
+        '''
+        self.conflate = val
+        return self
+
+    def connected(self, val=True):
+        ''' Queues messages only for peers that are connected, so sends to an endpoint that is
+            down block (or drop) at once instead of queueing until it comes up.
+            >>> ZeroSetup('push', 8000).connected()
+            ZeroSetup('push', 8000).binding(False).connected()
+        '''
+        self.immediate = val
+        return self
+
+    def dropping(self, val=True):
+        ''' Drops messages that do not fit in a full send queue instead of blocking. Dropped
+            messages and blocked sends are counted in Zero.stats().
+            >>> setup = ZeroSetup('push', 8011).watermarks(1).dropping()
+            >>> setup
+            ZeroSetup('push', 8011).binding(False).watermarks(1, None).dropping()
+            >>> zero = Zero(setup)
+            >>> zero.naptime = 0
+            >>> for i in range(5):
+            ...     zero(i)
+            >>> zero.stats()['dropped'] > 0
+            True
+            >>> zero.close()
+        '''
+        self.drop = val
+        return self
+
+    def spooling(self, path, size=64 << 20):
+        ''' Appends messages that do not fit in a full send queue to an on disk journal of at
+            most size bytes at path, and replays them in order when the peer drains. See
+            zero.spool.
+            >>> import os, tempfile
+            >>> path = os.path.join(tempfile.mkdtemp(), 'spool')
+            >>> zero = Zero(ZeroSetup('push', 8015).watermarks(1).spooling(path))
+            >>> zero.naptime = 0
+            >>> for i in range(5):
+            ...     zero(i)
+            >>> stats = zero.stats()
+            >>> stats['spooled'] > 0, stats['msgs_out'] + stats['spooled']
+            (True, 5)
+            >>> pull = Zero(ZeroSetup('pull', 8015))
+            >>> _ = pull.sock
+            >>> zero.drain()
+            True
+            >>> [pull.next() for _ in range(5)], zero.stats()['msgs_out']
+            ([0, 1, 2, 3, 4], 5)
+            >>> zero.close()
+            >>> pull.close()
+            >>> zero = Zero(ZeroSetup('push', 8025).watermarks(1).spooling(path + '2', 64))
+            >>> zero.naptime = 0
+            >>> for i in range(3):
+            ...     zero(i)
+            >>> zero('x' * 100)
+            Traceback (most recent call last):
+                ...
+            ValueError: ('Message larger than the spool', 102, 64)
+            >>> zero.close()
+        '''
+        self.spool = (path, size)
+        return self
+
     def opposite(self):
         ''' Returns a setup opposite of this, rep for req, push for pull etc.
             Flips binding and turns off debug.
@@ -278,21 +455,63 @@ class ZeroSetup(object):
         except AttributeError:
             raise UnsupportedZmqMethod('Unsupported ZMQ method', self._method, {})
 
+    def _urls(self, point):
+        'Returns the ZMQ socket strings for a single port or url, see transport.'
+        if str(point)[:1] == ':':
+            point = point[1:]
+        try:
+            int(point)
+        except ValueError:
+            return [point]
+        tcp = ('tcp://*:%s' if self.bind else 'tcp://localhost:%s') % point
+        if self._transport == 'tcp':
+            return [tcp]
+        ipc = 'ipc://%s/zero-%s.ipc' % (gettempdir(), point)
+        inproc = 'inproc://zero-%s' % point
+        if self._transport != 'auto':
+            return [{'ipc': ipc, 'inproc': inproc}[self._transport]]
+        if self.bind:
+            return [tcp, ipc, inproc]
+        if inproc in _inproc and _inproc[inproc] is getattr(self, 'ctx', None):
+            return [inproc]
+        if os.path.exists(ipc[6:]):
+            return [ipc]
+        return [tcp]
+
     @property
     def point(self):
-        ''' Returns the ZMQ socket string.
+        ''' Returns the ZMQ socket string, comma separated when there are several. Resolved on
+            each call, Zero.point has the strings its socket uses.
             >>> ZeroSetup('pull', 'tcp://other.host.net:9000')
             ZeroSetup('pull', 'tcp://other.host.net:9000').binding(True)
+            >>> ZeroSetup('push', [8000, 'tcp://other.host.net:9000']).point
+            'tcp://localhost:8000,tcp://other.host.net:9000'
         '''
-        if str(self._point)[:1] == ':':
-            self._point = self._point[1:]
-        try:
-            int(self._point)
-            if self.bind:
-                return 'tcp://*:%s' % self._point
-            return 'tcp://localhost:%s' % self._point
-        except ValueError:
-            return self._point
+        return ','.join(self.points)
+
+    @property
+    def points(self):
+        ''' Returns the list of ZMQ socket strings.
+            >>> ZeroSetup('pull', ':8000').points
+            ['tcp://*:8000']
+        '''
+        if isinstance(self._point, (list, tuple)):
+            return [url for point in self._point for url in self._urls(point)]
+        return self._urls(self._point)
+
+    def split(self):
+        ''' Returns a list of setups, one per endpoint.
+            >>> ZeroSetup('req', [8000, 8001]).split()
+            [ZeroSetup('req', 8000).binding(False), ZeroSetup('req', 8001).binding(False)]
+        '''
+        if not isinstance(self._point, (list, tuple)):
+            return [self]
+        res = []
+        for point in self._point:
+            setup = eval(repr(self))
+            setup._point = point
+            res.append(setup)
+        return res
 
     @property
     def transmits(self):
@@ -337,16 +556,37 @@ class Zero(object):
         self.setup = setup
         self.marshals()
         self.naptime = 0.5
+        self.zstats = ZeroStats()
+        self.tracer = None
+        self.compressor = None
+        self.arena = None
+        self.shares = False
+        self._span = None
+        self._spool = None
+        self.where = None
         if not hasattr(setup, 'ctx'):
-            setup.ctx = zmq.Context()
+            if setup._transport in ('inproc', 'auto'):
+                setup.ctx = zmq.Context.instance()
+            else:
+                setup.ctx = zmq.Context()
+        _zeros.add(self)
 
     def __del__(self):
         self.close()
 
     def close(self):
+        if self._spool:
+            self.drain(0)
+            self._spool.close()
+            self._spool = None
         if hasattr(self, '_sock'):
             self._sock.close()
             del self._sock
+            for url in self._urls if self.setup.bind else []:
+                if _inproc.get(url) is self.setup.ctx:
+                    del _inproc[url]
+                elif url.startswith('ipc://') and os.path.exists(url[6:]):
+                    os.unlink(url[6:])
 
     def marshals(self, encode=json.dumps, decode=json.loads):
         ''' Set automatic marshalling functions. Example for raw input:
@@ -356,6 +596,72 @@ class Zero(object):
         self._decode = decode
         return self
 
+    def compressing(self, compressor):
+        ''' Sets a zero.compress.Compressor for messages sent and received.
+            >>> from zero.compress import Compressor
+            >>> Zero(ZeroSetup('push', 8000)).compressing(Compressor(100))
+            Zero(ZeroSetup('push', 8000).binding(False)).compressing(Compressor(100))
+        '''
+        self.compressor = compressor
+        return self
+
+    def sharing(self, arena=None):
+        ''' Sends payloads of at least arena.threshold bytes through the shared memory arena (a
+            zero.shm.ShmArena) and receives shared payloads from any arena on this host. Leave
+            out arena for a Zero that only receives. See zero.shm.
+
+            With the default json marshalling shared payloads are copied out and released. Other
+            decode functions get the zero.shm.ShmBuffer and must release it.
+
+            A slot is released by the one receiver of its handle, so pub, sub and conflating
+            setups, where a handle may reach several receivers or none, can't share.
+            >>> Zero(ZeroSetup('sub', 8000)).sharing()  # doctest: +ELLIPSIS
+            Traceback (most recent call last):
+                ...
+            ValueError: Only push, pull, req and rep can share (Zero(ZeroSetup('sub', 8000)...))
+        '''
+        if self.setup.method in (zmq.PUB, zmq.SUB) or self.setup.conflate:
+            raise ValueError('Only push, pull, req and rep can share (%r)' % self)
+        self.arena = arena
+        self.shares = True
+        return self
+
+    def filtering(self, where):
+        ''' Only returns received messages that match where, a filter expression or a
+            zero.where.Where. With json marshalling, messages that can not match are rejected
+            before they are decoded. Others count as filtered in Zero.stats().
+            >>> push = Zero(ZeroSetup('push', 8020))
+            >>> pull = Zero(ZeroSetup('pull', 8020)).filtering('. > 2')
+            >>> pull
+            Zero(ZeroSetup('pull', 8020).binding(True)).filtering(Where('. > 2'))
+            >>> for msg in [1, 2, 5]:
+            ...     push(msg)
+            >>> pull.next(), pull.stats()['filtered']
+            (5, 2)
+            >>> push.close()
+            >>> pull.close()
+
+            Only pull and sub can skip messages; req and rep must answer each one.
+            >>> Zero(ZeroSetup('rep', 8000)).filtering('. > 2')  # doctest: +ELLIPSIS
+            Traceback (most recent call last):
+                ...
+            ValueError: Only pull and sub can filter (Zero(ZeroSetup('rep', 8000)...))
+        '''
+        if self.setup.method not in (zmq.PULL, zmq.SUB):
+            raise ValueError('Only pull and sub can filter (%r)' % self)
+        if isinstance(where, basestring):
+            from zero.where import Where
+            where = Where(where)
+        self.where = where
+        return self
+
+    def traced(self, tracer):
+        ''' Sets a zero.trace.Tracer that samples messages sent and records spans for traced
+            messages received.
+        '''
+        self.tracer = tracer
+        return self
+
     def activated(self, zerorpc):
         ''' Sets a ZeroRPC object that gets called when messages are received.
             >>> Zero(ZeroSetup('push', 8000)).activated(iter([]).next) # doctest: +ELLIPSIS
@@ -381,6 +687,14 @@ class Zero(object):
             res.append('.marshals(%r, %r)' % (self._encode, self._decode))
         if hasattr(self, 'rpc'):
             res.append('.activated(%r)' % self.rpc)
+        if self.compressor:
+            res.append('.compressing(%r)' % self.compressor)
+        if self.shares:
+            res.append('.sharing(%r)' % self.arena if self.arena else '.sharing()')
+        if self.tracer:
+            res.append('.traced(%r)' % self.tracer)
+        if self.where:
+            res.append('.filtering(%r)' % self.where)
         return ''.join(res)
     __str__ = __repr__
 
@@ -391,15 +705,49 @@ class Zero(object):
             self._sock = self.setup.ctx.socket(self.setup.method)
             if self.setup.linger:
                 self._sock.setsockopt(zmq.LINGER, self.setup.linger)
+            send, recv = self.setup.hwm
+            if send is not None:
+                self._sock.setsockopt(zmq.SNDHWM, send)
+            if recv is not None:
+                self._sock.setsockopt(zmq.RCVHWM, recv)
+            if self.setup.conflate:
+                self._sock.setsockopt(zmq.CONFLATE, 1)
+            if self.setup.immediate:
+                self._sock.setsockopt(zmq.IMMEDIATE, 1)
             for subsc in self.setup.subscriptions:
                 self._sock.setsockopt(zmq.SUBSCRIBE, subsc)
-            if self.setup.bind:
-                self._sock.bind(self.setup.point)
-            else:
-                self._sock.connect(self.setup.point)
+            self._urls = self.setup.points
+            self._url = ','.join(self._urls)
+            for point in self._urls:
+                if self.setup.bind:
+                    self._sock.bind(point)
+                    if point.startswith('inproc://'):
+                        _inproc[point] = self.setup.ctx
+                else:
+                    self._sock.connect(point)
             self.setup.debug('Created ZMQ socket %r', self)
         return self._sock
 
+    @property
+    def point(self):
+        'Returns the ZMQ socket string(s) of setup, as resolved when the socket was created.'
+        try:
+            return self._url
+        except AttributeError:
+            return self.setup.point
+
+    def stats(self):
+        ''' Returns a snapshot of message and byte counters and encode, decode, send wait and
+            receive idle timings (seconds) for this Zero.
+            >>> z = Zero(ZeroSetup('push', 8000)).stats()
+            >>> z['point'], z['msgs_out'], z['send_wait']['count']
+            ('tcp://localhost:8000', 0, 0)
+        '''
+        res = self.zstats.snapshot()
+        res['method'] = self.setup._method
+        res['point'] = self.point
+        return res
+
     def __iter__(self):
         return self
 
@@ -407,12 +755,38 @@ class Zero(object):
         ''' Receives a message. If method is rep, must send reply before going to next(). The
             message is unmarshalled and returned.
         '''
-        if not self.setup.block and not self.sock.poll(timeout=100): # Milliseconds; 0.1s
-            raise StopIteration()
-        res = self._decode(self.sock.recv())
-        self.setup.debug('Received %r from %s', res, self.setup.point)
+        start = time()
+        while True:
+            if not self.setup.block and not self.sock.poll(timeout=100): # Milliseconds; 0.1s
+                raise StopIteration()
+            frames = self.sock.recv_multipart()
+            msg = frames[0]
+            recvd = time()
+            if self.shares and msg[:2] == '\0s':
+                from zero.shm import unshare
+                msg = unshare(msg)
+                if self.compressor or self._decode == json.loads:
+                    msg = msg.read()
+            data = self.compressor.decompress(msg) if self.compressor else msg
+            if self.where and self._decode == json.loads and not self.where.raw(data):
+                self.zstats.count('filtered')
+                continue
+            res = self._decode(data)
+            if self.where and not self.where(res):
+                self.zstats.count('filtered')
+                if hasattr(msg, 'release'):
+                    msg.release()  # A zero.shm.ShmBuffer
+                continue
+            break
+        decode = time() - recvd
+        self.zstats.received(len(msg), recvd - start, decode)
+        if self.tracer and (len(frames) > 1 or self._span is not None):
+            self.tracer.incoming(self, frames[1:], recvd, decode)
+        self.setup.debug('Received %r from %s', res, self.point)
         if self.active:
-            return self.rpc(res)
+            res = self.rpc(res)
+        if self._span is not None:
+            self.tracer.handled(self)
         return res
 
     def __call__(self, obj):
@@ -432,14 +806,93 @@ class Zero(object):
         return False
 
     def send(self, obj):
-        from time import sleep
+        start = time()
         msg = self._encode(obj)
-        self.setup.debug('Sending %s to %s', msg, self.setup.point)
-        sleep(self.naptime)  # TODO: Find out how to tell when it is connected
-        self.naptime = 0
-        tracker = self.sock.send(msg, copy=False, track=True)
+        if self.compressor:
+            msg = self.compressor.compress(msg)
+        if self.arena and len(msg) >= self.arena.threshold:
+            msg = self.arena.put(msg) or msg
+        encoded = time()
+        self.setup.debug('Sending %s to %s', msg, self.point)
+        if self.naptime:
+            sleep(self.naptime)  # TODO: Find out how to tell when it is connected
+            self.naptime = 0
+            encoded = time()
+        envelope = self.tracer.outgoing(self, encoded - start) if self.tracer else None
+        try:
+            if self.setup.spool:
+                tracker = self._spooled(msg, envelope)
+                if tracker is None:
+                    return None
+            else:
+                tracker = self._send(msg, envelope, zmq.NOBLOCK)
+        except zmq.Again:
+            if self.setup.drop:
+                if self.arena and msg[:2] == '\0s':
+                    self.arena.release(json.loads(msg[2:])[1])
+                self.zstats.count('dropped')
+                self.setup.debug('Dropped message to %s', self.point)
+                return None
+            self.zstats.count('blocked')
+            blocked = time()
+            tracker = self._send(msg, envelope, 0)
+            self.zstats.timer('blocked_wait').record(time() - blocked)
         if self.setup.block:
             tracker.wait()
+        self.zstats.sent(len(msg), encoded - start, time() - encoded)
+        return tracker
+
+    def _spooled(self, msg, envelope):
+        ''' Sends msg unless there are spooled messages ahead of it or the queue is full, in
+            which case msg is spooled and None returned.
+        '''
+        if self.drain(0):
+            try:
+                return self._send(msg, envelope, zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+        if not self._spool.holds(msg):
+            raise ValueError('Message larger than the spool', len(msg), self._spool.size)
+        while not self._spool.append(msg):
+            # Spool full, wait until the oldest message is sent
+            self.zstats.count('blocked')
+            blocked = time()
+            oldest = self._spool.peek()
+            self._send(oldest, None, 0)
+            self._spool.pop()
+            self.zstats.timer('blocked_wait').record(time() - blocked)
+            self.zstats.sent(len(oldest), 0, 0)
+        self.zstats.count('spooled')
+
+    def drain(self, timeout=None):
+        ''' Replays spooled messages for up to timeout seconds (None waits until done). Returns
+            True when the spool is empty.
+        '''
+        if not self.setup.spool:
+            return True
+        if self._spool is None:
+            from zero.spool import Spool
+            self._spool = Spool(*self.setup.spool)
+        end = None if timeout is None else time() + timeout
+        msg = self._spool.peek()
+        while msg is not None:
+            try:
+                self._send(msg, None, zmq.NOBLOCK)
+            except zmq.Again:
+                if end is not None and time() >= end:
+                    return False
+                self.sock.poll(10, zmq.POLLOUT)
+                continue
+            self._spool.pop()
+            self.zstats.sent(len(msg), 0, 0)
+            msg = self._spool.peek()
+        return True
+
+    def _send(self, msg, envelope, flags):
+        'Sends the payload and the trace envelope, if any.'
+        if envelope:
+            return self.sock.send_multipart([msg, envelope], flags, copy=False, track=True)
+        return self.sock.send(msg, flags, copy=False, track=True)
 
     @property
     def active(self):
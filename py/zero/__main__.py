@@ -6,12 +6,27 @@ def main():
         sys.path.insert(0, '..')
         import zero
         import zero.rpc
-        fails, tests = doctest.testmod(zero)
-        fails2, tests2 = doctest.testmod(zero.rpc)
-        tests += tests2
-        if fails + fails2:
+        import zero.stats
+        import zero.trace
+        import zero.agent
+        import zero.balance
+        import zero.compress
+        import zero.shm
+        import zero.pipeline
+        import zero.spool
+        import zero.scale
+        import zero.record
+        import zero.where
+        fails = tests = 0
+        for mod in (zero, zero.rpc, zero.stats, zero.trace, zero.agent, zero.balance,
+                    zero.compress, zero.shm, zero.pipeline,
+                    zero.spool, zero.scale, zero.record, zero.where):
+            res = doctest.testmod(mod)
+            fails += res[0]
+            tests += res[1]
+        if fails:
             msg = 'Completed %d tests, %d failed. Run zero test -v for more information.'
-            sys.exit(msg % (tests, fails + fails2))
+            sys.exit(msg % (tests, fails))
         print 'Successfully completed %d tests.' % tests
         return
 
@@ -20,7 +35,30 @@ def main():
     try:
         # Regular zero run
         setup, loop = ZeroSetup.argv()
+        where = setup.args['--where']
+        if setup.args['record']:
+            from zero.record import zrecord
+            zero = Zero(setup)
+            if where:
+                zero.filtering(where)
+            zrecord(zero, setup.args['<file>'], loop)
+            return
+        if setup.args['replay']:
+            from zero.record import zreplay
+            speed = None if setup.args['--fast'] else float(setup.args['--speed'])
+            report = zreplay(Zero(setup), setup.args['<file>'], speed)
+            sys.stdout.write(json.dumps(report) + '\n')
+            return
+        if not setup.args['--wait'] and not setup.args['-'] and not where:
+            from zero.agent import zhandoff
+            res = zhandoff(setup, loop)
+            if res is not None:
+                for msg in res:
+                    sys.stdout.write(json.dumps(msg) + '\n')
+                return
         zero = Zero(setup)
+        if where:
+            zero.filtering(where)
 
         for msg in zauto(zero, loop, setup.args['--wait']):
             sys.stdout.write(json.dumps(msg) + '\n')
@@ -42,10 +80,32 @@ def main():
                         zero(msg)
             else:
                 raise ValueError('Multiple RPC workers not yet supported.', args['<type>'])
+        elif args['scale']:
+            from zero.scale import Supervisor
+            with open(args['<config>']) as fin:
+                config = json.load(fin)
+            sup = Supervisor(config, args['<type>'][0])
+            if args['--dbg']:
+                sup.setup.debugging(True)
+            sup.run()
+            return
+        elif args['agent']:
+            from zero.agent import zagent
+            zero = zagent(args['<socket>'])
+            setup = zero.setup
+            setup.args = args
+            if args['--dbg']:
+                setup.debugging(True)
+            try:
+                for msg in zero:
+                    zero(msg)
+            except KeyboardInterrupt:
+                setup.debug('Quit by user')
+            zero.rpc._close()
         else:
             # Something happened...
             raise e
-        if setup.args['--wait']:
+        if args['--wait']:
             raw_input('Press enter when done.')
         zero.close()
     
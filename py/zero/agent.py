@@ -0,0 +1,196 @@
+''' Warm local agent for the zero CLI.
+
+    Every zero CLI invocation pays for a new context, a new connection and the naptime before
+    the first send. The agent (zero agent) is a long running process that keeps a Zero per
+    ZeroSetup, connected and warm. When the agent is running, the CLI hands sends off to it over
+    a local ipc socket and just prints the result. Receives stay in the CLI: a pull or sub kept
+    connected in the agent would take messages meant for other receivers, and hold on to them
+    until the next invocation.
+
+    The agent listens on ipc:///tmp/zero-agent-<uid>.ipc unless ZERO_AGENT says otherwise.
+    Only setups that connect are handed off, so the agent never holds on to a port, and setups
+    travel as plain data (see setup_data), never as code.
+'''
+import os
+import zmq
+import json
+from time import time
+from zero import Zero, ZeroSetup
+from zero.rpc import ZeroRPC, RPCTimeout
+
+__all__ = ('ZeroAgent', 'zagent', 'zhandoff', 'agent_point')
+
+
+def agent_point():
+    'Returns the zmq url of the local agent.'
+    return os.environ.get('ZERO_AGENT', 'ipc:///tmp/zero-agent-%d.ipc' % os.getuid())
+
+
+def setup_data(setup):
+    ''' Returns a connecting sending setup as json friendly data for the agent.
+        >>> data = setup_data(ZeroSetup('push', 8000).watermarks(10).dropping())
+        >>> sorted(data.items())  # doctest: +NORMALIZE_WHITESPACE
+        [('conflate', False), ('drop', True), ('hwm', [10, None]), ('method', 'push'),
+         ('point', 8000), ('transport', 'tcp')]
+        >>> setup_from(data)
+        ZeroSetup('push', 8000).binding(False).watermarks(10, None).dropping()
+    '''
+    return {'method': setup._method, 'point': setup._point, 'transport': setup._transport,
+            'hwm': list(setup.hwm), 'conflate': setup.conflate, 'drop': setup.drop}
+
+
+def setup_from(data):
+    ''' Returns the connecting ZeroSetup for data made by setup_data.
+        >>> setup_from({'method': 'pull', 'point': 8000})
+        Traceback (most recent call last):
+            ...
+        ValueError: ('The agent does not handle', 'pull')
+        >>> setup_from({'method': 'push', 'point': "__import__('os')"})
+        ZeroSetup('push', "__import__('os')").binding(False)
+    '''
+    method = data['method']
+    if method not in ('push', 'pub', 'req'):
+        raise ValueError('The agent does not handle', method)
+    point = data['point']
+    for part in point if isinstance(point, list) else [point]:
+        if not isinstance(part, (int, basestring)):
+            raise ValueError('Bad point', point)
+    setup = ZeroSetup(method, point).binding(False)
+    setup.transport(data.get('transport', 'tcp'))
+    setup.watermarks(*data.get('hwm', [None, None]))
+    setup.conflating(bool(data.get('conflate')))
+    setup.dropping(bool(data.get('drop')))
+    return setup
+
+
+class ZeroAgent(ZeroRPC):
+    ''' RPC object for the agent. Keeps one warm Zero per setup (see setup_data).
+
+        >>> agent = ZeroAgent()
+        >>> agent.ping()
+        'pong'
+        >>> agent.zeros
+        {}
+    '''
+    def __init__(self):
+        self.zeros = {}
+
+    def _zero(self, setup):
+        key = json.dumps(setup, sort_keys=True)
+        if key not in self.zeros:
+            zero = Zero(setup_from(setup))
+            if zero.setup.method != zmq.PUB:
+                zero.naptime = 0  # send polls for the peer
+            self.zeros[key] = zero
+        return self.zeros[key]
+
+    def _drop(self, zero):
+        'Closes and forgets a Zero that is stuck, a req without reply for instance.'
+        for key, other in self.zeros.items():
+            if other is zero:
+                del self.zeros[key]
+        zero.sock.setsockopt(zmq.LINGER, 0)
+        zero.close()
+
+    def ping(self):
+        return 'pong'
+
+    def send(self, setup, messages, timeout=1000):
+        ''' Sends messages with the setup (see setup_data). Returns [<replies for req>, <number
+            of messages sent, for req those replied to>]. Stops early when a message can not be sent, or a req gets no
+            reply, within timeout milliseconds in all, so the agent keeps serving others.
+        '''
+        zero = self._zero(setup)
+        end = time() + timeout / 1000.0
+        res = []
+        sent = 0
+        for msg in messages:
+            if not zero.sock.poll(max(0, end - time()) * 1000, zmq.POLLOUT):
+                break
+            zero.send(msg)
+            if zero.setup.method == zmq.REQ:
+                if not zero.sock.poll(max(0, end - time()) * 1000):
+                    self._drop(zero)
+                    break
+                res.append(zero.next())
+            sent += 1
+        return [res, sent]
+
+    def _close(self):
+        'Closes all warm Zeros.'
+        for zero in self.zeros.values():
+            zero.close()
+        self.zeros.clear()
+
+
+def zagent(point=None):
+    ''' Returns an activated rep Zero for the agent. Run it like this:
+
+        zero = zagent()
+        for msg in zero:
+            zero(msg)
+    '''
+    zero = Zero(ZeroSetup('rep', point or agent_point())).activated(ZeroAgent())
+    zero.naptime = 0
+    return zero
+
+
+def zhandoff(setup, loop, timeout=200, point=None, wait=5000):
+    ''' Hands the work of zauto(Zero(setup), loop) to the local agent. Returns the list of
+        objects zauto would have yielded, or None when there is no agent (or it does not answer
+        a ping within timeout milliseconds) or the setup can't be handed off. Setups that bind,
+        receive or reply stay local. Sends that the agent can not complete
+        within wait milliseconds raise RPCTimeout with the messages not sent, unless none were
+        sent, then None is returned.
+
+        >>> import tempfile
+        >>> from threading import Thread
+        >>> point = 'ipc://%s/agent.ipc' % tempfile.mkdtemp()
+        >>> zhandoff(ZeroSetup('push', 8003), ['hi'], point=point) is None
+        True
+        >>> agent = zagent(point)
+        >>> _ = agent.sock
+        >>> def serve():
+        ...     for msg in agent:
+        ...         agent(msg)
+        >>> t = Thread(target=serve)
+        >>> t.daemon = True
+        >>> t.start()
+        >>> pull = Zero(ZeroSetup('pull', 8003))
+        >>> _ = pull.sock
+        >>> zhandoff(ZeroSetup('push', 8003), ['alpha', 'beta'], point=point)
+        []
+        >>> pull.next(), pull.next()
+        (u'alpha', u'beta')
+        >>> pull.close()
+        >>> zhandoff(ZeroSetup('pull', 8004).binding(False), xrange(1), point=point) is None
+        True
+        >>> zhandoff(ZeroSetup('push', 8004).binding(), ['gamma'], point=point) is None
+        True
+        >>> zhandoff(ZeroSetup('req', 8021), ['lost'], point=point, wait=100) is None
+        True
+    '''
+    point = point or agent_point()
+    if point.startswith('ipc://') and not os.path.exists(point[6:]):
+        return None
+    if setup.method not in (zmq.PUSH, zmq.PUB, zmq.REQ) or setup.bind:
+        return None
+    zero = Zero(ZeroSetup('req', point).nonblocking())
+    zero.naptime = 0
+    try:
+        zero.send(['ping'])
+        if not zero.sock.poll(timeout) or zero.next() != 'pong':
+            return None
+        messages = list(loop)
+        zero.send(['send', {'setup': setup_data(setup), 'messages': messages, 'timeout': wait}])
+        if not zero.sock.poll(wait + timeout):
+            raise RPCTimeout(messages, wait / 1000.0)
+        res, sent = zero.next()
+        if not sent and messages:
+            return None
+        if sent < len(messages):
+            raise RPCTimeout(messages[sent:], wait / 1000.0)
+        return res
+    finally:
+        zero.sock.setsockopt(zmq.LINGER, 0)
+        zero.close()
@@ -0,0 +1,204 @@
+''' Client side load balancing over the endpoints of a multi point ZeroSetup.
+
+    A push or req Zero connected to several endpoints lets libzmq round robin between them,
+    which keeps feeding a slow or dead worker its share. ZeroBalancer keeps one Zero per
+    endpoint instead and sends each message to the endpoint with the lowest observed latency
+    weighted by its in flight count. Endpoints that time out are ejected for a while.
+    zero.rpc.RPCClient picks req replicas the same way (see rank).
+
+    Push endpoints only queue for a connected peer (see ZeroSetup.connected), so an endpoint
+    that is down, or whose queue is full, can't take a message and counts as failing.
+'''
+from time import time
+from collections import deque
+from zero import Zero
+
+__all__ = ('ZeroBalancer',)
+
+_FLOOR = 0.0001  # Seconds added to latencies, so endpoints without samples still rank by load
+_WINDOW = 1.0  # Seconds a pushed message counts as in flight
+
+
+class Endpoint(object):
+    'Latency and in flight book keeping for one endpoint of a ZeroBalancer.'
+    def __init__(self, zero, alpha):
+        self.zero = zero
+        self.alpha = alpha
+        self.latency = 0.0
+        self.failures = 0
+        self.ejected = 0
+        self.pending = deque()
+
+    def fail(self, failures, eject):
+        'Counts a failure. Returns True when it is the failures-th in a row and ejects.'
+        self.failures += 1
+        if self.failures < failures:
+            return False
+        self.failures = 0
+        self.ejected = time() + eject
+        return True
+
+    def pushed(self, now):
+        'Counts a message taken by the endpoint.'
+        self.failures = self.ejected = 0
+        self.pending.append(now)
+
+    def observe(self, secs):
+        'Folds a latency sample into the moving average.'
+        self.failures = self.ejected = 0
+        if self.latency:
+            self.latency += self.alpha * (secs - self.latency)
+        else:
+            self.latency = secs
+
+    @property
+    def inflight(self):
+        ''' Number of messages pushed in the last _WINDOW seconds, an estimate of those the peer
+            is still working on. Always 0 for req, which waits for each reply.
+        '''
+        limit = time() - _WINDOW
+        while self.pending and self.pending[0] < limit:
+            self.pending.popleft()
+        return len(self.pending)
+
+    @property
+    def score(self):
+        return (self.latency + _FLOOR) * (1 + self.inflight)
+
+    def stats(self):
+        return {'point': self.zero.point, 'latency': self.latency,
+                'inflight': self.inflight, 'ejected': self.ejected > time()}
+
+
+def rank(endpoints):
+    'Returns endpoints best first: by score, ejected ones last.'
+    now = time()
+    return sorted(endpoints, key=lambda ep: (ep.ejected > now, ep.score))
+
+
+class ZeroBalancer(object):
+    ''' Callable like a push or req Zero, but balances over all endpoints of setup.
+
+        A req call that gets no reply within timeout seconds resets the socket and raises
+        zero.rpc.RPCTimeout. A push endpoint that can't take a message counts as a failure and
+        the next best one is tried; when none takes it within timeout seconds RPCTimeout is
+        raised. After failures consecutive failures an endpoint is ejected for eject seconds;
+        when all endpoints are ejected they are all used again.
+
+        >>> from threading import Thread
+        >>> from zero import ZeroSetup
+        >>> from zero.rpc import ZeroRPC
+        >>> class Ping(ZeroRPC):
+        ...     def ping(self):
+        ...         return 'pong'
+        >>> rep = Zero(ZeroSetup('rep', 8008)).activated(Ping())
+        >>> rep.naptime = 0
+        >>> t = Thread(target=lambda: [rep(rep.next()) for _ in range(4)])
+        >>> t.start()
+        >>> lb = ZeroBalancer(ZeroSetup('req', [8008, 8009]), timeout=0.2, failures=1)
+        >>> lb
+        ZeroBalancer(ZeroSetup('req', [8008, 8009]).binding(False))
+        >>> lb(['ping'])
+        u'pong'
+        >>> lb(['ping'])
+        Traceback (most recent call last):
+            ...
+        RPCTimeout: (['ping'], 0.2)
+        >>> [lb(['ping']) for _ in range(3)]
+        [u'pong', u'pong', u'pong']
+        >>> [ep['ejected'] for ep in lb.stats()]
+        [False, True]
+        >>> t.join()
+        >>> lb.close()
+        >>> rep.close()
+        >>> pull = Zero(ZeroSetup('pull', 8024))
+        >>> _ = pull.sock
+        >>> lb = ZeroBalancer(ZeroSetup('push', [8023, 8024]), timeout=1, failures=1)
+        >>> for i in range(20):
+        ...     lb(i)
+        >>> len([pull.next() for _ in range(20)]), [ep['ejected'] for ep in lb.stats()]
+        (20, [True, False])
+        >>> lb.close()
+        >>> pull.close()
+    '''
+    def __init__(self, setup, timeout=1.0, failures=2, eject=5.0, alpha=0.2):
+        self.setup = setup
+        self.timeout = timeout
+        self.failures = failures
+        self.eject = eject
+        self.endpoints = []
+        for single in setup.split():
+            if single.transmits and not single.yields:
+                single.connected()
+            zero = Zero(single.nonblocking())
+            zero.naptime = 0
+            self.endpoints.append(Endpoint(zero, alpha))
+        self.compressor = None
+
+    def __repr__(self):
+        if self.compressor:
+            return 'ZeroBalancer(%r).compressing(%r)' % (self.setup, self.compressor)
+        return 'ZeroBalancer(%r)' % self.setup
+
+    def compressing(self, compressor):
+        'Sets a zero.compress.Compressor on the Zero of every endpoint.'
+        self.compressor = compressor
+        for endpoint in self.endpoints:
+            endpoint.zero.compressing(compressor)
+        return self
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.zero.close()
+
+    def stats(self):
+        'Returns latency, in flight count and ejection state per endpoint.'
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def _choose(self):
+        return rank(self.endpoints)[0]
+
+    def _fail(self, endpoint):
+        if endpoint.fail(self.failures, self.eject):
+            self.setup.debug('Ejected %s for %ss', endpoint.zero.point, self.eject)
+
+    def __call__(self, obj):
+        ''' Sends obj to the best endpoint. For req the reply is returned.
+        '''
+        import zmq
+        if self.endpoints[0].zero.setup.method != zmq.REQ:
+            return self._push(obj)
+        endpoint = self._choose()
+        zero = endpoint.zero
+        start = time()
+        zero.send(obj)
+        if zero.sock.poll(self.timeout * 1000):
+            res = zero.next()
+            endpoint.observe(time() - start)
+            return res
+        from zero.rpc import RPCTimeout
+        zero.sock.setsockopt(zmq.LINGER, 0)
+        zero.close()
+        self._fail(endpoint)
+        raise RPCTimeout(obj, self.timeout)
+
+    def _push(self, obj):
+        'Pushes obj to the best endpoint that can take it, waiting up to timeout for one.'
+        import zmq
+        for endpoint in rank(self.endpoints):
+            if endpoint.zero.sock.poll(0, zmq.POLLOUT):
+                endpoint.zero.send(obj)  # None when dropped or spooled, still taken
+                endpoint.pushed(time())
+                return
+            self._fail(endpoint)
+        poller = zmq.Poller()
+        for endpoint in self.endpoints:
+            poller.register(endpoint.zero.sock, zmq.POLLOUT)
+        ready = dict(poller.poll(self.timeout * 1000))
+        for endpoint in rank(self.endpoints):
+            if endpoint.zero.sock in ready:
+                endpoint.zero.send(obj)
+                endpoint.pushed(time())
+                return
+        from zero.rpc import RPCTimeout
+        raise RPCTimeout(obj, self.timeout)
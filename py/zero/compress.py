@@ -0,0 +1,88 @@
+''' Optional compression of encoded messages, with stdlib zlib only.
+
+    Compressed messages start with a NUL byte, which no json message does, followed by a tag:
+    'z' for plain deflate and 'd' plus the crc32 of the shared dictionary when one is used.
+    Messages under the threshold go out as they are, so a compressing Zero reads messages from
+    peers that don't compress, and vice versa for small messages.
+
+    zlib in python 2 has no preset dictionaries, so the dictionary is fed to a compressor that
+    is then copied for each message; only the output after the dictionary is sent. Both sides
+    must have the same dictionary.
+
+    >>> comp = Compressor(10)
+    >>> comp.compress('short')
+    'short'
+    >>> msg = '["sender", "host", "fyi", "2013-01-01T00:00:00UTC", "hello hello hello"]'
+    >>> packed = comp.compress(msg)
+    >>> packed[:2], len(packed) < len(msg), comp.decompress(packed) == msg
+    ('\\x00z', True, True)
+    >>> comp.decompress('["not compressed"]')
+    '["not compressed"]'
+'''
+import zlib
+import struct
+
+__all__ = ('Compressor',)
+
+
+class Compressor(object):
+    ''' Compresses messages of at least threshold bytes, optionally with a shared dictionary,
+        a string of typical message content (keys, sender names etc).
+
+        >>> dictionary = '["sender", "host", "fyi", "wtf", "omg", "2013-01-01T00:00:00UTC"'
+        >>> comp = Compressor(10, dictionary)
+        >>> comp  # doctest: +ELLIPSIS
+        Compressor(10, <dictionary ...>)
+        >>> msg = '["sender", "host", "fyi", "2013-02-01T00:00:00UTC", "hello"]'
+        >>> packed = comp.compress(msg)
+        >>> len(packed) < len(Compressor(10).compress(msg)), comp.decompress(packed) == msg
+        (True, True)
+        >>> Compressor(10, 'other').decompress(packed)
+        Traceback (most recent call last):
+            ...
+        ValueError: Compressed with a different dictionary
+    '''
+    def __init__(self, threshold=256, dictionary=None, level=6):
+        self.threshold = threshold
+        self.dictionary = dictionary
+        self.level = level
+        self._comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self._decomp = zlib.decompressobj(-15)
+        self._tag = '\0z'
+        if dictionary:
+            self._tag = '\0d' + struct.pack('!I', zlib.crc32(dictionary) & 0xffffffff)
+            self._decomp.decompress(self._comp.compress(dictionary) +
+                                    self._comp.flush(zlib.Z_SYNC_FLUSH))
+
+    @classmethod
+    def from_config(cls, conf):
+        ''' Returns a Compressor for a "compress" config node, or None when conf is None.
+            {"threshold": 256, "dictionary": "...", "level": 6}
+        '''
+        if conf is None:
+            return None
+        return cls(conf.get('threshold', 256), conf.get('dictionary'), conf.get('level', 6))
+
+    def __repr__(self):
+        if self.dictionary:
+            return 'Compressor(%r, <dictionary %s>)' % (self.threshold,
+                                                        self._tag[2:].encode('hex'))
+        return 'Compressor(%r)' % self.threshold
+
+    def compress(self, msg):
+        'Returns msg, compressed and tagged when it is large enough.'
+        if len(msg) < self.threshold:
+            return msg
+        comp = self._comp.copy()
+        return self._tag + comp.compress(msg) + comp.flush()
+
+    def decompress(self, msg):
+        'Returns msg, decompressed if it is tagged as compressed.'
+        if msg[:1] != '\0':
+            return msg
+        if msg[:2] == '\0z':
+            return zlib.decompress(msg[2:], -15)
+        if msg[:6] != self._tag:
+            raise ValueError('Compressed with a different dictionary')
+        decomp = self._decomp.copy()
+        return decomp.decompress(msg[6:]) + decomp.flush()
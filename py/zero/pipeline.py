@@ -0,0 +1,253 @@
+''' Fan out, fan in pipelines: a source, map stages run by pools of workers, and a sink.
+
+    Each map stage has a router thread that binds the stage input (pull), the work queue
+    (push) and a credit queue (pull). Workers, threads or processes, pull work, push results to
+    the next stage input and hand a credit back to the router. The router only takes input
+    while it has credits, so no stage runs more than credit items ahead of its workers.
+
+    End of stream: the source sends 'eos' after its last item. When a router has seen eos from
+    every upstream sender and has all its credits back, it tells each worker to stop, and each
+    worker forwards eos downstream on the same socket as its results. Workers confirm on the
+    credit queue; a stop that push handed to a worker which had already stopped (one that
+    connected late gets no share of the round robin) is sent again.
+
+    When func raises, the worker sends the traceback downstream in place of the result, later
+    stages pass it on, and run raises PipelineError with the first traceback once the pipeline
+    has drained. So does the source, before ending the stream.
+
+    >>> results = []
+    >>> pipe = Pipeline(range(20)).map(lambda x: x * x, parallel=3).map(lambda x: x + 1)
+    >>> stats = pipe.sink(results.append).run()
+    >>> [(stage['stage'], stage['items']) for stage in stats]
+    [(0, 20), (1, 20)]
+    >>> sorted(results) == [x * x + 1 for x in range(20)]
+    True
+    >>> results = []
+    >>> stats = Pipeline(range(5), processes=True).map(str, parallel=2).sink(results.append).run()
+    >>> sorted(results), [stage['parallel'] for stage in stats]
+    ([u'0', u'1', u'2', u'3', u'4'], [2])
+    >>> try:
+    ...     Pipeline(range(5)).map(lambda x: 1 / x, parallel=2).map(str).run()
+    ... except PipelineError, e:
+    ...     print e.args[0].splitlines()[-1]
+    ZeroDivisionError: integer division or modulo by zero
+    >>> def source():
+    ...     yield 1
+    ...     raise IOError('Gone')
+    >>> try:
+    ...     Pipeline(source()).map(str).run()
+    ... except PipelineError, e:
+    ...     print e.args[0].splitlines()[-1]
+    IOError: Gone
+'''
+import os
+import zmq
+from time import time
+from threading import Thread
+from traceback import format_exc
+from zero import Zero, ZeroSetup
+
+__all__ = ('Pipeline', 'PipelineError')
+
+
+class PipelineError(Exception):
+    'Signals that the source or a map function raised. The argument is the traceback.'
+
+
+class Pipeline(object):
+    ''' Declares and runs a pipeline. source is any iterable of json friendly objects.
+        processes=True runs workers in processes (ipc) instead of threads (inproc).
+    '''
+    def __init__(self, source, processes=False):
+        self.source = source
+        self.processes = processes
+        self.stages = []
+        self._sink = None
+        self.stats = []
+        self._dir = None
+        if processes:
+            from tempfile import mkdtemp
+            self._dir = mkdtemp()
+            self._base = 'ipc://%s/' % self._dir
+        else:
+            self._base = 'inproc://zero-pipeline-%d-%d-' % (os.getpid(), id(self))
+
+    def __repr__(self):
+        return 'Pipeline(%r)' % self.stages
+
+    def map(self, func, parallel=1, credit=None):
+        ''' Adds a stage that calls func on each item with parallel workers. credit is the
+            number of items handed to the workers at once, default twice parallel.
+        '''
+        self.stages.append(_Stage(self, len(self.stages), func, parallel,
+                                  credit or 2 * parallel))
+        return self
+
+    def sink(self, func):
+        'Sets the function called with each result, in the thread calling run.'
+        self._sink = func
+        return self
+
+    def _setup(self, method, name, bind):
+        setup = ZeroSetup(method, self._base + name).binding(bind)
+        if method == 'push':
+            setup.nonblocking()
+        if not self.processes:
+            setup.ctx = zmq.Context.instance()
+        zero = Zero(setup)
+        zero.naptime = 0
+        return zero
+
+    def run(self):
+        ''' Runs the pipeline until the source is exhausted and every result has reached the
+            sink. Returns per stage stats: items, seconds and rate (items per second). Raises
+            PipelineError when the source or a map function raised.
+        '''
+        sink = self._setup('pull', 'in%d' % len(self.stages), True)
+        _ = sink.sock
+        senders = [1] + [stage.parallel for stage in self.stages]
+        for stage, nsenders in zip(self.stages, senders):
+            stage.start(nsenders)
+
+        def feed():
+            zero = self._setup('push', 'in0', False)
+            try:
+                for item in self.source:
+                    zero(['item', item])
+            except Exception:
+                zero(['error', format_exc()])
+            zero(['eos'])
+            zero.close()
+        feeder = Thread(name='zero pipeline source', target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        eos = 0
+        error = None
+        for msg in sink:
+            if msg[0] == 'eos':
+                eos += 1
+                if eos == senders[-1]:
+                    break
+            elif msg[0] == 'error':
+                error = error or msg[1]
+            elif self._sink:
+                self._sink(msg[1])
+        feeder.join()
+        for stage in self.stages:
+            stage.join()
+        sink.close()
+        if self._dir:
+            from shutil import rmtree
+            rmtree(self._dir, True)
+        self.stats = [stage.stats() for stage in self.stages]
+        if error:
+            raise PipelineError(error)
+        return self.stats
+
+
+class _Stage(object):
+    'One map stage: its router and workers.'
+    def __init__(self, pipe, index, func, parallel, credit):
+        self.pipe = pipe
+        self.index = index
+        self.func = func
+        self.parallel = parallel
+        self.credit = credit
+        self.items = 0
+        self.start_time = self.end_time = None
+        self.input = pipe._setup('pull', 'in%d' % index, True)
+        self.work = pipe._setup('push', 'work%d' % index, True)
+        self.credits = pipe._setup('pull', 'credit%d' % index, True)
+        for zero in (self.input, self.work, self.credits):
+            _ = zero.sock
+        self.workers = []
+        self.router = None
+
+    def __repr__(self):
+        return '_Stage(%r, parallel=%r)' % (self.func, self.parallel)
+
+    def start(self, senders):
+        'Starts the workers and the router thread.'
+        if self.pipe.processes:
+            from multiprocessing import Process as Worker
+        else:
+            Worker = Thread
+        for i in range(self.parallel):
+            worker = Worker(name='zero pipeline %d.%d' % (self.index, i), target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.router = Thread(name='zero pipeline %d' % self.index, target=self._route,
+                             args=(senders,))
+        self.router.daemon = True
+        self.router.start()
+
+    def join(self):
+        self.router.join()
+        for worker in self.workers:
+            worker.join()
+
+    def stats(self):
+        secs = (self.end_time or time()) - (self.start_time or time())
+        return {'stage': self.index, 'parallel': self.parallel, 'items': self.items,
+                'seconds': secs, 'rate': self.items / secs if secs else 0.0}
+
+    def _route(self, senders):
+        poller = zmq.Poller()
+        poller.register(self.credits.sock, zmq.POLLIN)
+        poller.register(self.input.sock, zmq.POLLIN)
+        credits, outstanding, eos = self.credit, 0, 0
+        while eos < senders or outstanding:
+            poller.modify(self.input.sock, zmq.POLLIN if credits and eos < senders else 0)
+            ready = dict(poller.poll())
+            if self.credits.sock in ready:
+                self.credits.next()
+                credits += 1
+                outstanding -= 1
+            if self.input.sock in ready:
+                msg = self.input.next()
+                if msg[0] == 'eos':
+                    eos += 1
+                    continue
+                if self.start_time is None:
+                    self.start_time = time()
+                self.work(msg)
+                self.items += 1
+                credits -= 1
+                outstanding += 1
+        self.end_time = time()
+        for _ in range(self.parallel):
+            self.work(['stop'])
+        stopped = 0
+        while stopped < self.parallel:
+            if self.credits.sock.poll(500):
+                self.credits.next()
+                stopped += 1
+            else:
+                self.work(['stop'])
+        for zero in (self.input, self.work, self.credits):
+            zero.close()
+
+    def _worker(self):
+        pipe = self.pipe
+        work = pipe._setup('pull', 'work%d' % self.index, False)
+        out = pipe._setup('push', 'in%d' % (self.index + 1), False)
+        credits = pipe._setup('push', 'credit%d' % self.index, False)
+        for msg in work:
+            if msg[0] == 'stop':
+                out(['eos'])
+                credits('stopped')
+                break
+            if msg[0] == 'error':
+                out(msg)  # From an earlier stage
+            else:
+                try:
+                    out(['item', self.func(msg[1])])
+                except Exception:
+                    out(['error', format_exc()])
+            credits(1)
+        for zero in (work, out, credits):
+            zero.close()
+            if pipe.processes:
+                zero.setup.ctx.term()  # Flushes before the process exits
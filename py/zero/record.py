@@ -0,0 +1,168 @@
+''' Recording and replaying of traffic, for load tests with realistic messages and timing.
+
+    A recording is a file starting with 'ZREC1' followed by one record per message: the
+    receive time (double) and length (unsigned int) in network order, then the message as it
+    came off the wire, after decompression but not decoded.
+
+    >>> import os, tempfile
+    >>> from threading import Thread
+    >>> from zero import Zero, ZeroSetup
+    >>> path = os.path.join(tempfile.mkdtemp(), 'traffic.zrec')
+    >>> push = Zero(ZeroSetup('push', 8018))
+    >>> t = Thread(target=lambda: [push(['work', i]) for i in range(5)])
+    >>> t.start()
+    >>> zrecord(Zero(ZeroSetup('pull', 8018)), path, range(5))
+    5
+    >>> t.join()
+    >>> [msg for _, msg in records(path)][:2]
+    ['["work", 0]', '["work", 1]']
+    >>> pull = Zero(ZeroSetup('pull', 8019))
+    >>> report = zreplay(Zero(ZeroSetup('push', 8019)), path, speed=10)
+    >>> [pull.next() for _ in range(5)][-1]
+    [u'work', 4]
+    >>> report['messages'], sorted(report)
+    (5, ['latency', 'messages', 'rate', 'recorded_rate', 'seconds', 'speed'])
+    >>> zreplay(Zero(ZeroSetup('push', 8019)), path, speed=None)['messages']
+    5
+    >>> len([pull.next() for _ in range(5)])
+    5
+    >>> pull.close()
+    >>> push.close()
+
+    With a filter (see Zero.filtering) only matching messages are recorded, still as received:
+
+    >>> from zero.where import Where
+    >>> push = Zero(ZeroSetup('push', 8022))
+    >>> t = Thread(target=lambda: [push(['work', i]) for i in range(6)])
+    >>> t.start()
+    >>> zrecord(Zero(ZeroSetup('pull', 8022)).filtering(Where('[1] > 3')), path, range(2))
+    2
+    >>> t.join()
+    >>> push.close()
+    >>> [msg for _, msg in records(path)]
+    ['["work", 4]', '["work", 5]']
+'''
+import json
+import struct
+from time import time, sleep
+from itertools import izip
+
+__all__ = ('Recorder', 'records', 'zrecord', 'zreplay')
+
+_MAGIC = 'ZREC1'
+_RECORD = struct.Struct('!dI')
+
+
+def _raw(msg):
+    return msg
+
+
+class Recorder(object):
+    'Writes a recording to path.'
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.fout = open(path, 'wb')
+        self.fout.write(_MAGIC)
+
+    def __repr__(self):
+        return 'Recorder(%r)' % self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        self.close()
+        return False
+
+    def write(self, msg, ts=None):
+        'Appends msg (a string) received at ts, default now.'
+        self.fout.write(_RECORD.pack(time() if ts is None else ts, len(msg)))
+        self.fout.write(msg)
+        self.count += 1
+
+    def close(self):
+        self.fout.close()
+
+
+def records(path):
+    'Yields (timestamp, message) from the recording at path.'
+    with open(path, 'rb') as fin:
+        if fin.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('Not a zero recording', path)
+        while True:
+            head = fin.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            ts, length = _RECORD.unpack(head)
+            yield ts, fin.read(length)
+
+
+def _matching(zero, where):
+    'Yields the raw messages received by zero that match where, a decoded json filter.'
+    for msg in zero:
+        if where.raw(msg) and where(json.loads(msg)):
+            yield msg
+        else:
+            zero.zstats.count('filtered')
+
+
+def zrecord(zero, path, loop):
+    ''' Records a message received by zero (a pull or sub Zero) to path for each step of loop.
+        Returns the number of messages recorded. zero is closed when done.
+    '''
+    zero.marshals(_raw, _raw)
+    msgs = zero
+    if zero.where:
+        msgs = _matching(zero, zero.where)
+        zero.where = None  # Zero would test the raw strings, filter decoded copies instead
+    with Recorder(path) as rec:
+        try:
+            for _, msg in izip(loop, msgs):
+                rec.write(msg)
+        except KeyboardInterrupt:
+            zero.setup.debug('Quit by user')
+        finally:
+            zero.close()
+    zero.setup.debug('Recorded %d messages to %s', rec.count, path)
+    return rec.count
+
+
+def zreplay(zero, path, speed=1.0):
+    ''' Sends the messages recorded at path through zero (push, pub or req) at speed times the
+        recorded pace, or as fast as possible when speed is None. Returns a report with the
+        achieved and recorded rates (messages per second) and a histogram of the time spent in
+        each send, the round trip for req. zero is closed when done.
+    '''
+    from zero.stats import Histogram
+    zero.marshals(_raw, _raw)
+    if zero.naptime:
+        sleep(zero.naptime)  # Time to connect, not part of the replay
+        zero.naptime = 0
+    latency = Histogram()
+    first = last = start = None
+    count = 0
+    try:
+        for ts, msg in records(path):
+            now = time()
+            if first is None:
+                first, start = ts, now
+            elif speed:
+                delay = start + (ts - first) / speed - now
+                if delay > 0:
+                    sleep(delay)
+            sent = time()
+            zero(msg)
+            latency.record(time() - sent)
+            last = ts
+            count += 1
+    except KeyboardInterrupt:
+        zero.setup.debug('Quit by user')
+    finally:
+        zero.close()
+    secs = time() - start if count else 0.0
+    recorded = last - first if count else 0.0
+    return {'messages': count, 'seconds': secs, 'speed': speed,
+            'rate': count / secs if secs else 0.0,
+            'recorded_rate': count / recorded if recorded else 0.0,
+            'latency': latency.snapshot()}
@@ -1,9 +1,21 @@
 ''' Base classes for use by workers (not intended to be used outside this module.
 '''
 import json
-from itertools import izip
+from time import time
+from types import GeneratorType
+from collections import deque
+from itertools import izip, count
 
-__all__ = ('ZeroRPC', 'ConfiguredRPC', 'zrpc')
+__all__ = ('ZeroRPC', 'ConfiguredRPC', 'zrpc', 'zclient', 'zstream', 'RPCClient', 'RPCTimeout',
+           'RPCError')
+
+
+class RPCTimeout(Exception):
+    'Signals that an RPCClient call got no reply before its deadline.'
+
+
+class RPCError(Exception):
+    'Signals an ERROR reply. The argument is the traceback from the worker.'
 
 
 class ZeroRPC(object):
@@ -11,11 +23,24 @@ class ZeroRPC(object):
         Then supply to ZeroSetup:
 
         Zero(ZeroSetup('pull', 8000)).activated(ZeroRPC())
+
+        Methods that are generators stream their results over rep: the reply is
+        ['STREAM', <stream id>, [<chunks>...], <ended>] with at most stream_credit chunks, and
+        the client asks for more with ['_stream', {'sid': <stream id>, 'credit': <n>}] (credit 0
+        ends the stream). Only credit chunks are ever pulled from the generator ahead of the
+        client, see zstream. Streams left alone for stream_timeout seconds are closed. Stream ids
+        start with stream_prefix, when set, so several workers can hand out unique ids.
     '''
+    stream_credit = 16
+    stream_timeout = 60.0
+    stream_prefix = None
+
     def __call__(self, obj):
         'Calls the method from obj (always of the form [<method name>, {<kwargs>}]).'
         from traceback import format_exc
         try:
+            if obj[0] == '_stream':
+                return self._stream(**obj[1])
             if obj[0][:1] == '_':
                 raise Exception('Method not available')
             if len(obj) == 1:
@@ -23,11 +48,68 @@ class ZeroRPC(object):
             if not hasattr(self, obj[0]):
                 return self._unsupported(obj[0], **obj[1])
             func = getattr(self, obj[0])
-            return func(**obj[1])
+            span = getattr(getattr(self, 'zero', None), '_span', None)
+            start = time()
+            res = func(**obj[1])
+            if isinstance(res, GeneratorType):
+                res = self._stream(self._open_stream(res), self.stream_credit)
+            if span is not None:
+                span['name'] = obj[0]
+                span['method'] = time() - start
+            return res
         except:
             self.zero.setup.err('Exception: ' + format_exc())
             return ['ERROR', format_exc()]
 
+    def _open_stream(self, gen):
+        'Registers generator gen as a stream and returns its id.'
+        if not hasattr(self, '_streams'):
+            self._streams = {}
+            self._stream_ids = count(1)
+        self._expire()
+        sid = next(self._stream_ids)
+        if self.stream_prefix:
+            sid = '%s%d' % (self.stream_prefix, sid)
+        self._streams[sid] = (gen, time())
+        return sid
+
+    def _expire(self):
+        'Closes streams left alone for stream_timeout seconds.'
+        now = time()
+        for sid, (_, touched) in getattr(self, '_streams', {}).items():
+            if now - touched > self.stream_timeout:
+                self._streams.pop(sid)[0].close()
+
+    def _streaming(self):
+        'Returns the number of open streams, after closing expired ones.'
+        self._expire()
+        return len(getattr(self, '_streams', {}))
+
+    def _stream(self, sid, credit):
+        'Returns the next batch of at most credit chunks of stream sid.'
+        streams = getattr(self, '_streams', {})
+        if sid not in streams:
+            raise KeyError('No such stream', sid)
+        gen = streams[sid][0]
+        chunks = []
+        if credit > 0:
+            try:
+                for chunk in gen:
+                    chunks.append(chunk)
+                    if len(chunks) >= credit:
+                        break
+                else:
+                    credit = 0
+            except:
+                del streams[sid]
+                raise
+        if credit > 0:
+            streams[sid] = (gen, time())
+        else:
+            del streams[sid]
+            gen.close()
+        return ['STREAM', sid, chunks, credit <= 0]
+
     def _unsupported(self, func, **kwargs):
         'Catch-all method for when the object received does not fit.'
         return ['UnsupportedFunc', func, kwargs]
@@ -103,10 +185,26 @@ class ConfiguredRPC(ZeroRPC):
 
         Each worker has a module and class name as well as a zmq configuration. Additional keys
         may be added. zero.rpc will ignore everything outside of "workers" -> (worker type) -> 
-        ["module", "class", "zmq" -> ["method", "port", "debug"*, "bind"*, "host"*]].
+        ["module", "class", "zmq" -> ["method", "port", "debug"*, "bind"*, "host"*, "hosts"*,
+        "trace"*, "compress"*], "scale"*].
 
         *) optional
 
+        "hosts" lists the hosts that run a worker of this type, clients made with zclient
+        balance their calls over all of them.
+
+        "trace" enables sampled tracing (see zero.trace) and looks like this:
+            {"sample": 0.01, "collector": 8300}
+        The collector is a port or zmq url to push spans to, or a path to a span file.
+
+        "compress" compresses large messages (see zero.compress) and looks like this:
+            {"threshold": 256, "dictionary": "[\"sender\", \"host\", ..."}
+        Clients must use the same dictionary.
+
+        "scale" is read by zero.scale.Supervisor, which runs between min and max worker
+        processes behind the port, see there:
+            {"min": 1, "max": 8, "target": 0.05, "up": 5, "down": 30}
+
         To instantiate a worker from the config do something similar to this:
 
         from zero.rpc import zrpc
@@ -159,16 +257,325 @@ def zrpc(sysconfig, workertype):
     from zero import Zero, ZeroSetup
     wconf = sysconfig['workers'][workertype]
     zconf = wconf['zmq']
-    setup = ZeroSetup(zconf['method'], zconf['port']).debugging(zconf.get('debug', False))
-    if 'bind' in zconf:
-        setup.binding(zconf['bind'])
-    if 'host' in zconf and not setup.bind:
-        setup._point = 'tcp://%(host)s:%(port)s' % zconf
+    zero = Zero(_zsetup(zconf))
+    if 'compress' in zconf:
+        from zero.compress import Compressor
+        zero.compressing(Compressor.from_config(zconf['compress']))
+    if 'trace' in zconf:
+        from zero.trace import Tracer
+        collector = zconf['trace']['collector']
+        if isinstance(collector, int) or '://' in collector:
+            collector = ZeroSetup('push', collector)
+        zero.traced(Tracer(zconf['trace'].get('sample', 0.01), collector))
+    return zero.activated(_worker_rpc(sysconfig, workertype))
+
+
+def _worker_rpc(sysconfig, workertype):
+    'Returns an instance of the RPC class of workertype in sysconfig.'
+    wconf = sysconfig['workers'][workertype]
     mod = __import__(wconf['module'])
     for modpart in wconf['module'].split('.')[1:]:
         mod = getattr(mod, modpart)
     klass = getattr(mod, wconf['class'])
-    return Zero(setup).activated(klass(sysconfig, workertype))
+    return klass(sysconfig, workertype)
+
+
+def _zsetup(zconf, client=False):
+    'Returns the ZeroSetup for a worker zmq config, or for its clients.'
+    from zero import ZeroSetup
+    setup = ZeroSetup(zconf['method'], zconf['port']).debugging(zconf.get('debug', False))
+    if 'bind' in zconf:
+        setup.binding(zconf['bind'])
+    if client:
+        setup = setup.opposite()
+    if not setup.bind:
+        if 'hosts' in zconf:
+            setup._point = ['tcp://%s:%s' % (host, zconf['port']) for host in zconf['hosts']]
+        elif 'host' in zconf:
+            setup._point = 'tcp://%(host)s:%(port)s' % zconf
+    return setup
+
+
+def zstream(zero, obj, credit=16):
+    ''' Calls obj on a req Zero and yields the chunks of a streamed reply as they are needed,
+        asking for credit chunks at a time. A reply that is not a stream is yielded as is.
+        Closing the generator early ends the stream on the worker. An ERROR reply, from the
+        method or the generator raising or the stream having expired, raises RPCError.
+        >>> from threading import Thread
+        >>> from zero import Zero, ZeroSetup
+        >>> class Lister(ZeroRPC):
+        ...     stream_credit = 2
+        ...     def count(self, n):
+        ...         for i in xrange(n):
+        ...             yield i
+        ...     def total(self, n):
+        ...         return sum(range(n))
+        ...     def broken(self):
+        ...         yield 1
+        ...         yield 2
+        ...         raise ValueError('Broken')
+        >>> rpc = Lister()
+        >>> rep = Zero(ZeroSetup('rep', 8016)).activated(rpc)
+        >>> rep.naptime = 0
+        >>> t = Thread(target=lambda: [rep(rep.next()) for _ in range(8)])
+        >>> t.start()
+        >>> req = Zero(ZeroSetup('req', 8016))
+        >>> req.naptime = 0
+        >>> list(zstream(req, ['count', {'n': 7}], credit=3))
+        [0, 1, 2, 3, 4, 5, 6]
+        >>> list(zstream(req, ['total', {'n': 7}]))
+        [21]
+        >>> chunks = zstream(req, ['broken'])
+        >>> next(chunks), next(chunks)
+        (1, 2)
+        >>> try:
+        ...     next(chunks)
+        ... except RPCError, e:
+        ...     print e.args[0].splitlines()[-1]
+        ValueError: Broken
+        >>> len(rpc._streams)
+        0
+        >>> chunks = zstream(req, ['count', {'n': 1000000}])
+        >>> next(chunks), next(chunks), len(rpc._streams)
+        (0, 1, 1)
+        >>> chunks.close()
+        >>> t.join()
+        >>> len(rpc._streams)
+        0
+        >>> req.close()
+        >>> rep.close()
+    '''
+    res = zero(obj)
+    if isinstance(res, list) and len(res) == 2 and res[0] == 'ERROR':
+        raise RPCError(res[1])
+    if not (isinstance(res, list) and len(res) == 4 and res[0] == 'STREAM'):
+        yield res
+        return
+    _, sid, chunks, ended = res
+    try:
+        while True:
+            for chunk in chunks:
+                yield chunk
+            if ended:
+                break
+            res = zero(['_stream', {'sid': sid, 'credit': credit}])
+            if res[0] == 'ERROR':
+                ended = True  # The worker dropped the stream
+                raise RPCError(res[1])
+            _, sid, chunks, ended = res
+    finally:
+        if not ended:
+            zero(['_stream', {'sid': sid, 'credit': 0}])
+
+
+def zclient(sysconfig, workertype, **kwargs):
+    ''' Returns an RPCClient that calls all the hosts of workertype in sysconfig. kwargs go to
+        RPCClient.
+        >>> cfg = {'workers': {'common': {'zmq': {'port': 8000, 'method': 'rep',
+        ...                                       'hosts': ['alpha', 'beta']}}}}
+        >>> zclient(cfg, 'common')  # doctest: +NORMALIZE_WHITESPACE
+        RPCClient([ZeroSetup('req', 'tcp://alpha:8000').binding(False).nonblocking(),
+                   ZeroSetup('req', 'tcp://beta:8000').binding(False).nonblocking()])
+        >>> cfg['workers']['common']['zmq']['compress'] = {'threshold': 100}
+        >>> zclient(cfg, 'common').endpoints[1].zero.compressor
+        Compressor(100)
+    '''
+    zconf = sysconfig['workers'][workertype]['zmq']
+    client = RPCClient(_zsetup(zconf, client=True), **kwargs)
+    if 'compress' in zconf:
+        from zero.compress import Compressor
+        client.compressing(Compressor.from_config(zconf['compress']))
+    return client
+
+
+class RPCClient(object):
+    ''' Calls RPC methods on one or more req replicas with a deadline per call. setups is a
+        list of req setups or a single setup with several endpoints.
+
+        Each call goes to the replica with the lowest latency, as zero.balance.ZeroBalancer
+        chooses. A call that times out resets its socket (lazy pirate: close and reconnect,
+        dropping the pending request) and counts as a failure of the replica; after failures
+        in a row it is ejected for eject seconds. Methods listed in idempotent are retried, the
+        deadline split over the attempts, and may be hedged: when the replica has not answered
+        by the p95 latency of earlier calls (hedge_after seconds until there are enough of
+        them), the same call goes to the next best replica and the first reply wins. The p95 is
+        taken over the last window latencies. An ERROR reply raises RPCError.
+
+        >>> from time import sleep
+        >>> from threading import Thread
+        >>> from zero import Zero, ZeroSetup
+        >>> class Ping(ZeroRPC):
+        ...     def __init__(self, delay):
+        ...         self.delay = delay
+        ...     def ping(self):
+        ...         sleep(self.delay)
+        ...         return 'pong'
+        ...     def fail(self):
+        ...         raise ValueError('Down')
+        >>> def serve(port, delay, count):
+        ...     zero = Zero(ZeroSetup('rep', port)).activated(Ping(delay))
+        ...     zero.naptime = 0
+        ...     for _, msg in izip(range(count), zero):
+        ...         zero(msg)
+        ...     zero.close()
+        >>> slow = Thread(target=serve, args=(8006, 0.5, 1))
+        >>> fast = Thread(target=serve, args=(8007, 0, 3))
+        >>> slow.start(); fast.start()
+        >>> client = RPCClient([ZeroSetup('req', 8006), ZeroSetup('req', 8007)],
+        ...                    idempotent=['ping'], hedge=True)
+        >>> start = time()
+        >>> client(['ping'])
+        u'pong'
+        >>> time() - start < 0.4, client.counters['hedged']
+        (True, 1)
+        >>> [endpoint['point'] for endpoint in sorted(client.stats(), key=lambda s: s['latency'])]
+        ['tcp://localhost:8007', 'tcp://localhost:8006']
+        >>> client(['ping'], deadline=0.1)
+        u'pong'
+        >>> try:
+        ...     client(['fail'])
+        ... except RPCError, e:
+        ...     print e.args[0].splitlines()[-1]
+        ValueError: Down
+        >>> client(['ping'], deadline=0.1)
+        Traceback (most recent call last):
+            ...
+        RPCTimeout: (['ping'], 0.1)
+        >>> slow.join(); fast.join()
+        >>> client.close()
+    '''
+    def __init__(self, setups, deadline=1.0, retries=2, idempotent=(), hedge=False,
+                 hedge_after=0.05, failures=2, eject=5.0, alpha=0.2, window=100):
+        from zero import Zero, ZeroSetup
+        from zero.stats import Histogram
+        from zero.balance import Endpoint
+        if isinstance(setups, ZeroSetup):
+            setups = setups.split()
+        self.endpoints = []
+        for setup in setups:
+            zero = Zero(setup.nonblocking())
+            zero.naptime = 0
+            self.endpoints.append(Endpoint(zero, alpha))
+        self.deadline = deadline
+        self.retries = retries
+        self.idempotent = set(idempotent)
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.failures = failures
+        self.eject = eject
+        self.compressor = None
+        self.latency = Histogram()
+        self.recent = deque(maxlen=window)
+        self.counters = {'calls': 0, 'retries': 0, 'hedged': 0, 'timeouts': 0, 'errors': 0}
+
+    def __repr__(self):
+        res = 'RPCClient(%r)' % [endpoint.zero.setup for endpoint in self.endpoints]
+        if self.compressor:
+            res += '.compressing(%r)' % self.compressor
+        return res
+
+    def compressing(self, compressor):
+        'Sets a zero.compress.Compressor on the Zero of every replica.'
+        self.compressor = compressor
+        for endpoint in self.endpoints:
+            endpoint.zero.compressing(compressor)
+        return self
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.zero.close()
+
+    def stats(self):
+        'Returns latency, in flight count and ejection state per replica.'
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def _pick(self):
+        'Returns replicas best first, see zero.balance.rank.'
+        from zero.balance import rank
+        return rank(self.endpoints)
+
+    @staticmethod
+    def _reset(zero):
+        'Drops the pending request, the socket reconnects on next use.'
+        import zmq
+        zero.sock.setsockopt(zmq.LINGER, 0)
+        zero.close()
+
+    def _attempt(self, obj, timeout, hedge):
+        ''' Sends obj and waits up to timeout seconds. Returns (True, reply) or (False, None).
+            Raises RPCError for an ERROR reply.
+        '''
+        import zmq
+        endpoints = self._pick()
+        start = time()
+        poller = zmq.Poller()
+        pending = [endpoints[0]]
+        sent = [start]
+        endpoints[0].zero.send(obj)
+        poller.register(endpoints[0].zero.sock, zmq.POLLIN)
+        hedge = hedge and len(endpoints) > 1
+        wait = timeout
+        if hedge and len(self.recent) >= 20:
+            wait = min(timeout, sorted(self.recent)[int(len(self.recent) * 0.95) - 1])
+        elif hedge:
+            wait = min(timeout, self.hedge_after)
+        while True:
+            ready = dict(poller.poll(wait * 1000))
+            for endpoint in pending:
+                if endpoint.zero.sock in ready:
+                    res = endpoint.zero.next()
+                    if isinstance(res, list) and len(res) == 2 and res[0] == 'ERROR':
+                        for other in pending:
+                            if other is not endpoint:
+                                self._reset(other.zero)
+                        self.counters['errors'] += 1
+                        raise RPCError(res[1])
+                    now = time()
+                    self.latency.record(now - start)
+                    self.recent.append(now - start)
+                    for other, when in zip(pending, sent):
+                        other.observe(now - when)  # At least that for the loser of a hedge
+                        if other is not endpoint:
+                            self._reset(other.zero)
+                    return True, res
+            wait = timeout - (time() - start)
+            if wait <= 0:
+                break
+            if hedge and len(pending) == 1:
+                self.counters['hedged'] += 1
+                pending.append(endpoints[1])
+                sent.append(time())
+                endpoints[1].zero.send(obj)
+                poller.register(endpoints[1].zero.sock, zmq.POLLIN)
+        for endpoint in pending:
+            self._reset(endpoint.zero)
+            if endpoint.fail(self.failures, self.eject):
+                endpoint.zero.setup.debug('Ejected %s for %ss', endpoint.zero.point,
+                                          self.eject)
+        return False, None
+
+    def __call__(self, obj, deadline=None):
+        ''' Calls obj ([<method name>, {<kwargs>}]) and returns the reply. Raises RPCTimeout
+            when there is no reply within deadline seconds (default self.deadline), and
+            RPCError when the method raised.
+        '''
+        deadline = deadline or self.deadline
+        idempotent = obj[0] in self.idempotent
+        attempts = 1 + (self.retries if idempotent else 0)
+        end = time() + deadline
+        self.counters['calls'] += 1
+        for attempt in range(attempts):
+            remaining = end - time()
+            if remaining <= 0:
+                break
+            if attempt:
+                self.counters['retries'] += 1
+            found, res = self._attempt(obj, remaining / (attempts - attempt),
+                                       self.hedge and idempotent)
+            if found:
+                return res
+        self.counters['timeouts'] += 1
+        raise RPCTimeout(obj, deadline)
 
 
 def _test():
@@ -0,0 +1,330 @@
+''' Autoscaling supervisor for configured RPC workers.
+
+    The supervisor binds the port of a worker type in place of a single rep worker. Clients
+    keep using req (or zclient) as before. Requests wait in a queue in the supervisor until a
+    worker process is free; workers connect to the supervisor over ipc, say they are ready and
+    get one request at a time (the load balancing broker pattern).
+
+    Every interval seconds the supervisor looks at the time requests spent in the queue and
+    at how busy the workers were. When the p95 time in queue is over target it starts a
+    worker, when the queue is empty and utilization is under the low mark it retires an idle
+    one, always between min and max workers and no sooner than the up and down cooldowns
+    after the last change. Dead workers are replaced.
+
+    Supervisor.stats() has the queue depth, workers, utilization, time in queue and the last
+    scaling decisions. A running supervisor is included by the zero.stats exporter.
+
+    Streams (see zero.rpc.zstream) live in the worker that opened them: stream ids carry the
+    worker identity, requests for more chunks wait for that worker, and workers with open
+    streams are not retired.
+'''
+import os
+import zmq
+import json
+from time import time
+from collections import deque
+from threading import Thread
+
+__all__ = ('Supervisor',)
+
+_DEFAULTS = {'min': 1, 'max': 4, 'target': 0.05, 'low': 0.3, 'up': 5.0, 'down': 30.0,
+             'interval': 1.0}
+
+
+class Supervisor(object):
+    ''' Runs workertype from sysconfig with min to max worker processes. Settings come from
+        the "scale" node of the worker config (see zero.rpc.ConfiguredRPC), kwargs override:
+
+        min, max -- bounds on the number of worker processes
+        target   -- p95 seconds in queue above which a worker is added
+        low      -- utilization (busy share of worker time) below which a worker is retired
+        up, down -- seconds after the last change before adding or retiring a worker
+        interval -- seconds between scaling decisions
+
+        >>> from zero import Zero, ZeroSetup
+        >>> from zero.test import _get_test_config
+        >>> cfg = _get_test_config()
+        >>> cfg['workers']['common']['zmq']['port'] = 8017
+        >>> sup = Supervisor(cfg, 'common', max=3, target=0.01, up=0, down=0.3, interval=0.05)
+        >>> sup
+        Supervisor('common', 1, 3)
+        >>> sup = sup.start()
+        >>> def call(msg):
+        ...     zero = Zero(ZeroSetup('req', 8017))
+        ...     zero.naptime = 0
+        ...     res = zero(msg)
+        ...     zero.close()
+        ...     return res
+        >>> call(['ping'])
+        u'pong'
+        >>> clients = [Thread(target=call, args=(['nap', {'secs': 0.1}],)) for _ in range(30)]
+        >>> for client in clients:
+        ...     client.start()
+        >>> for client in clients:
+        ...     client.join()
+        >>> stats = sup.stats()
+        >>> stats['requests'], stats['spawned'] > 1, stats['decisions'][0]['action']
+        (31, True, 'up')
+        >>> from zero.rpc import zstream
+        >>> req = Zero(ZeroSetup('req', 8017))
+        >>> req.naptime = 0
+        >>> list(zstream(req, ['count', {'n': 40}], credit=2)) == range(40)
+        True
+        >>> req.close()
+        >>> from time import sleep
+        >>> while sup.stats()['workers'] > 1:
+        ...     sleep(0.1)
+        >>> sup.stats()['decisions'][-1]['action']
+        'down'
+        >>> sup.stop()
+    '''
+    def __init__(self, sysconfig, workertype, **kwargs):
+        from zero.rpc import _zsetup
+        from zero.stats import Histogram
+        wconf = sysconfig['workers'][workertype]
+        conf = dict(_DEFAULTS)
+        conf.update(wconf.get('scale', {}))
+        conf.update(kwargs)
+        self.sysconfig = sysconfig
+        self.workertype = workertype
+        self.setup = _zsetup(wconf['zmq'])
+        for name, value in conf.items():
+            setattr(self, name, value)
+        self.wait = Histogram()
+        self.counters = {'requests': 0, 'spawned': 0, 'retired': 0}
+        self.decisions = deque(maxlen=20)
+        self.utilization = 0.0
+        self.processes = {}  # Worker identity -> multiprocessing.Process
+        self.streaming = {}  # Worker identity -> number of open streams
+        self.idle = deque()
+        self.busy = set()
+        self.queue = deque()  # (arrival time, request frames)
+        self._window = Histogram()
+        self._busy_secs = 0.0
+        self._running = False
+        self._thread = None
+        self._dir = None
+
+    def __repr__(self):
+        return 'Supervisor(%r, %r, %r)' % (self.workertype, self.min, self.max)
+
+    def stats(self):
+        'Returns a json friendly snapshot of the queue, the workers and scaling decisions.'
+        res = dict(self.counters)
+        res.update({'method': 'supervisor', 'point': self.setup.point, 'type': self.workertype,
+                    'workers': len(self.processes), 'busy': len(self.busy),
+                    'queue': len(self.queue), 'utilization': self.utilization,
+                    'wait': self.wait.snapshot(), 'decisions': list(self.decisions)})
+        return res
+
+    def start(self):
+        'Runs the supervisor in a daemon thread.'
+        self._thread = Thread(name='zero supervisor %s' % self.workertype, target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        'Stops a supervisor started with start.'
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        'Runs the supervisor until stop is called or the process is interrupted.'
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from zero.stats import _zeros
+        self._dir = mkdtemp()
+        self._backend = 'ipc://%s/workers' % self._dir
+        ctx = zmq.Context()
+        front = ctx.socket(zmq.ROUTER)
+        back = ctx.socket(zmq.ROUTER)
+        for point in self.setup.points:
+            front.bind(point)
+        back.bind(self._backend)
+        poller = zmq.Poller()
+        poller.register(front, zmq.POLLIN)
+        poller.register(back, zmq.POLLIN)
+        _zeros.add(self)
+        self._running = True
+        for _ in range(self.min):
+            self._spawn()
+        tick = last = time()
+        try:
+            while self._running:
+                ready = dict(poller.poll(self.interval * 1000))
+                now = time()
+                self._busy_secs += len(self.busy) * (now - last)
+                last = now
+                if back in ready:
+                    self._from_worker(back.recv_multipart(), front)
+                if front in ready:
+                    self.queue.append((now, front.recv_multipart()))
+                    self.counters['requests'] += 1
+                self._dispatch(now, back)
+                if now - tick >= self.interval:
+                    self._scale(now, now - tick, back)
+                    tick = now
+        except KeyboardInterrupt:
+            self.setup.debug('Quit by user')
+        finally:
+            _zeros.discard(self)
+            for worker in list(self.idle):
+                back.send_multipart([worker, '', 'STOP'])
+            for process in self.processes.values():
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+            self.processes.clear()
+            front.close(0)
+            back.close(0)
+            ctx.term()
+            rmtree(self._dir, True)
+
+    def _dispatch(self, now, back):
+        'Hands queued requests to idle workers, stream requests to the worker with the stream.'
+        waiting = deque()
+        while self.queue and self.idle:
+            arrived, frames = self.queue.popleft()
+            worker = _owner(frames)
+            if worker not in self.processes:
+                worker = self.idle[0]
+            elif worker not in self.idle:
+                waiting.append((arrived, frames))
+                continue
+            self.idle.remove(worker)
+            self._window.record(now - arrived)
+            self.wait.record(now - arrived)
+            self.busy.add(worker)
+            back.send_multipart([worker, ''] + frames)
+        waiting.extend(self.queue)
+        self.queue = waiting
+
+    def _from_worker(self, frames, front):
+        ''' Handles READY, [worker, "", "READY"], or a reply, [worker, "", <open streams>,
+            <client envelope>..., reply], from a worker.
+        '''
+        worker = frames[0]
+        self.busy.discard(worker)
+        if worker in self.processes:
+            self.idle.append(worker)
+        if frames[2:] != ['READY']:
+            self.streaming[worker] = int(frames[2])
+            front.send_multipart(frames[3:])
+
+    def _spawn(self):
+        from multiprocessing import Process
+        identity = '%s-%d-%d' % (self.workertype, os.getpid(), self.counters['spawned'])
+        process = Process(name='zero worker %s' % identity, target=_work,
+                          args=(self.sysconfig, self.workertype, self._backend, identity))
+        process.daemon = True
+        process.start()
+        self.processes[identity] = process
+        self.counters['spawned'] += 1
+
+    def _retirable(self):
+        'Returns an idle worker without open streams, or None.'
+        for worker in reversed(self.idle):
+            if not self.streaming.get(worker):
+                return worker
+        return None
+
+    def _retire(self, worker, back):
+        self.idle.remove(worker)
+        self.streaming.pop(worker, None)
+        back.send_multipart([worker, '', 'STOP'])
+        self.processes.pop(worker).join(1)
+        self.counters['retired'] += 1
+
+    def _scale(self, now, secs, back):
+        'Replaces dead workers and adds or retires one when the last window calls for it.'
+        for worker, process in self.processes.items():
+            if not process.is_alive():
+                self.setup.warn('Worker %s died, exit code %s', worker, process.exitcode)
+                del self.processes[worker]
+                self.streaming.pop(worker, None)
+                self.busy.discard(worker)
+                if worker in self.idle:
+                    self.idle.remove(worker)
+        while len(self.processes) < self.min:
+            self._spawn()
+        workers = len(self.processes)
+        self.utilization = self._busy_secs / (workers * secs) if workers else 0.0
+        waited = self._window.percentile(95)
+        if self.queue:
+            waited = max(waited, now - self.queue[0][0])
+        self._busy_secs = 0.0
+        self._window = type(self._window)()
+        since = now - (self.decisions[-1]['time'] if self.decisions else 0)
+        if waited > self.target and workers < self.max and since >= self.up:
+            action = 'up'
+            self._spawn()
+        elif (not self.queue and self.utilization < self.low and workers > self.min and
+              since >= self.down and self._retirable()):
+            action = 'down'
+            self._retire(self._retirable(), back)
+        else:
+            return
+        decision = {'time': now, 'action': action, 'workers': len(self.processes),
+                    'queue': len(self.queue), 'wait_p95': waited,
+                    'utilization': self.utilization}
+        self.decisions.append(decision)
+        self.setup.debug('Scaled %s %s', self.workertype, json.dumps(decision))
+
+
+def _split(frames):
+    ''' Splits a request from the supervisor, [<client envelope>..., "", payload, <trace>...],
+        into the envelope with its delimiter and the payload.
+        >>> _split(['client', '', '["ping"]', '<trace envelope>'])
+        (['client', ''], '["ping"]')
+    '''
+    end = frames.index('') + 1
+    return frames[:end], frames[end]
+
+
+def _owner(frames):
+    ''' Returns the identity of the worker with the stream of a request for more chunks, or
+        None for other requests. Those are small, so never compressed.
+        >>> _owner(['client', '', '["_stream", {"sid": "common-1-0:3", "credit": 2}]'])
+        'common-1-0'
+        >>> _owner(['client', '', '["ping"]'])
+    '''
+    msg = _split(frames)[1]
+    if not msg.startswith('["_stream"'):
+        return None
+    try:
+        return str(json.loads(msg)[1]['sid'].rsplit(':', 1)[0])
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def _work(sysconfig, workertype, point, identity):
+    'Worker process main: serves requests from the supervisor at point until told to STOP.'
+    from zero import Zero, ZeroSetup
+    from zero.rpc import _worker_rpc
+    from zero.compress import Compressor
+    zconf = sysconfig['workers'][workertype]['zmq']
+    compressor = Compressor.from_config(zconf.get('compress'))
+    rpc = _worker_rpc(sysconfig, workertype)
+    rpc.stream_prefix = identity + ':'
+    setup = ZeroSetup('req', point).debugging(zconf.get('debug', False))
+    Zero(setup).activated(rpc)  # Gives rpc its setup for logging, messages go through sock
+    sock = setup.ctx.socket(zmq.REQ)  # Not a Zero socket, the identity goes before connect
+    sock.setsockopt(zmq.IDENTITY, identity)
+    sock.connect(point)
+    sock.send('READY')
+    while True:
+        frames = sock.recv_multipart()
+        if frames == ['STOP']:
+            break
+        envelope, msg = _split(frames)
+        if compressor:
+            msg = compressor.decompress(msg)
+        res = json.dumps(rpc(json.loads(msg)))
+        if compressor:
+            res = compressor.compress(res)
+        sock.send_multipart([str(rpc._streaming())] + envelope + [res])
+    sock.close()
+    setup.ctx.term()
@@ -0,0 +1,182 @@
+''' Shared memory transport for bulk payloads between Zeros on the same host.
+
+    The sender copies a large encoded payload into a slot of a memory mapped file and sends
+    only a handle, '\\0s' followed by json [path, slot, length]. The receiver maps the same file
+    and reads the payload in place. The first byte of every slot, in the arena header, tells
+    whether it is in use; the receiver clears it when the payload is released, so slots are
+    reused in ring order without another message going back.
+
+    A payload that does not fit in a slot, or finds no free slot, is sent inline as usual.
+
+    >>> import os, tempfile
+    >>> from zero import Zero, ZeroSetup
+    >>> path = os.path.join(tempfile.mkdtemp(), 'arena')
+    >>> arena = ShmArena(path, slots=2, slot_size=1 << 20, threshold=1000)
+    >>> push = Zero(ZeroSetup('push', 8012)).marshals(str, lambda x: x).sharing(arena)
+    >>> pull = Zero(ZeroSetup('pull', 8012)).marshals(str, lambda x: x).sharing()
+    >>> push('x' * 500000)
+    >>> buf = pull.next()
+    >>> buf
+    ShmBuffer(0, 500000)
+    >>> len(buf), buf.data[:3], arena.free
+    (500000, 'xxx', 1)
+    >>> buf.release()
+    >>> arena.free
+    2
+    >>> push('small')
+    >>> pull.next()
+    'small'
+    >>> json_push = Zero(ZeroSetup('push', 8013)).sharing(arena)
+    >>> json_pull = Zero(ZeroSetup('pull', 8013)).sharing()
+    >>> json_push(range(1000))
+    >>> json_pull.next()[-1], arena.free
+    (999, 2)
+    >>> for zero in (push, pull, json_push, json_pull):
+    ...     zero.close()
+    >>> arena.close(unlink=True)
+'''
+import os
+import mmap
+import struct
+from json import dumps, loads
+
+__all__ = ('ShmArena', 'ShmBuffer', 'unshare')
+
+_MAGIC = 'ZSHM'
+_HEADER = struct.Struct('!4sII')
+_attached = {}
+
+
+class ShmArena(object):
+    ''' A memory mapped file of slots number of slot_size byte slots. Payloads of at least
+        threshold bytes are shared through it. Use a path in /dev/shm so the pages never hit a
+        disk. Without a path the arena gets a new file there (or in the temp dir), which is
+        removed when the arena is closed.
+        >>> first, second = ShmArena(slots=1, slot_size=10), ShmArena(slots=1, slot_size=10)
+        >>> first.path != second.path, first.put('in use') is not None, second.free, first.free
+        (True, True, 1, 0)
+        >>> for arena in (first, second):
+        ...     arena.close()
+        >>> os.path.exists(first.path)
+        False
+    '''
+    def __init__(self, path=None, slots=16, slot_size=4 << 20, threshold=64 << 10,
+                 create=True):
+        self._unlink = path is None
+        if path is None:
+            from tempfile import gettempdir, mkstemp
+            shm = '/dev/shm' if os.path.isdir('/dev/shm') else gettempdir()
+            fd, path = mkstemp(prefix='zero-%d-' % os.getpid(), dir=shm)
+            create = True
+        elif create:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+        self.path = path
+        self.threshold = threshold
+        self._next = 0
+        if create:
+            self.slots, self.slot_size = slots, slot_size
+            os.ftruncate(fd, self._base + slots * slot_size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            magic, self.slots, self.slot_size = _HEADER.unpack(os.read(fd, _HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError('Not a shared memory arena', path)
+        self.mm = mmap.mmap(fd, self._base + self.slots * self.slot_size)
+        os.close(fd)
+        if create:
+            self.mm[:_HEADER.size] = _HEADER.pack(_MAGIC, slots, slot_size)
+
+    @classmethod
+    def attach(cls, path):
+        'Returns the arena at path, mapped once per process.'
+        if path not in _attached:
+            _attached[path] = cls(path, create=False)
+        return _attached[path]
+
+    def __repr__(self):
+        return 'ShmArena(%r, %r, %r, %r)' % (self.path, self.slots, self.slot_size,
+                                             self.threshold)
+
+    @property
+    def _base(self):
+        'Offset of the first slot, page aligned after the header and in use flags.'
+        size = _HEADER.size + self.slots
+        return (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+
+    @property
+    def free(self):
+        'Number of slots not in use.'
+        flags = self.mm[_HEADER.size:_HEADER.size + self.slots]
+        return flags.count('\0')
+
+    def put(self, data):
+        ''' Copies data into a free slot and returns its handle, or None when data is too
+            large or all slots are in use.
+        '''
+        if len(data) > self.slot_size:
+            return None
+        for i in range(self.slots):
+            slot = (self._next + i) % self.slots
+            if self.mm[_HEADER.size + slot] == '\0':
+                break
+        else:
+            return None
+        self._next = (slot + 1) % self.slots
+        offset = self._base + slot * self.slot_size
+        self.mm[offset:offset + len(data)] = data
+        self.mm[_HEADER.size + slot] = '\1'
+        return '\0s' + dumps([self.path, slot, len(data)])
+
+    def release(self, slot):
+        'Marks slot as free.'
+        self.mm[_HEADER.size + slot] = '\0'
+
+    def close(self, unlink=False):
+        'Unmaps the arena, and removes the file when unlink is set or the arena named it.'
+        self.mm.close()
+        if _attached.get(self.path) is self:
+            del _attached[self.path]
+        if unlink or self._unlink:
+            os.unlink(self.path)
+
+
+class ShmBuffer(object):
+    ''' A payload received through an arena. data is a read only buffer over the shared pages
+        (no copy). Call release, or use as a context manager, when done so the sender can
+        reuse the slot.
+    '''
+    def __init__(self, arena, slot, length):
+        self.arena = arena
+        self.slot = slot
+        self.data = buffer(arena.mm, arena._base + slot * arena.slot_size, length)
+
+    def __repr__(self):
+        return 'ShmBuffer(%r, %r)' % (self.slot, len(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        self.release()
+        return False
+
+    def release(self):
+        'Frees the slot. data must not be used after this.'
+        if self.arena:
+            self.arena.release(self.slot)
+            self.arena = None
+
+    def read(self):
+        'Returns a copy of the payload and releases the slot.'
+        res = str(self.data)
+        self.release()
+        return res
+
+
+def unshare(handle):
+    'Returns a ShmBuffer for a handle made by ShmArena.put.'
+    path, slot, length = loads(handle[2:])
+    return ShmBuffer(ShmArena.attach(path), slot, length)
@@ -0,0 +1,139 @@
+''' Disk spool for push Zeros whose peer is absent or slow.
+
+    With ZeroSetup.spooling(path, size), a message that does not fit in the send queue is
+    appended to a memory mapped journal of at most size bytes instead of blocking or growing
+    memory. Once something is spooled, new messages go behind it, and every send first tries
+    to replay the spool in order. Zero.drain replays without sending anything new.
+
+    The journal is a ring of [length, payload] records. The read and write offsets in its
+    header are only moved after the record is written, or sent, so a producer that crashes
+    loses nothing: the next Zero spooling to the same path replays from the last offset. A
+    crash between a send and the offset update sends that message again.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'spool')
+    >>> spool = Spool(path, 64)
+    >>> spool.append('alpha'), spool.append('beta'), spool.append('x' * 60)
+    (True, True, False)
+    >>> spool.peek(), len(spool), spool.holds('x' * 60), spool.holds('x' * 61)
+    ('alpha', 2, True, False)
+    >>> spool.close()
+    >>> spool = Spool(path, 64)
+    >>> spool.pop(), spool.pop(), spool.pop()
+    ('alpha', 'beta', None)
+    >>> for _ in range(2):  # The second round wraps around the end of the ring
+    ...     print [spool.append('message %d' % i) for i in range(3)],
+    ...     print [spool.pop() for i in range(3)]
+    [True, True, True] ['message 0', 'message 1', 'message 2']
+    [True, True, True] ['message 0', 'message 1', 'message 2']
+    >>> spool.close()
+'''
+import os
+import mmap
+import struct
+
+__all__ = ('Spool',)
+
+_MAGIC = 'ZSPL'
+_HEADER = struct.Struct('!4sQQQ')  # magic, size, head (read) offset, tail (write) offset
+_LEN = struct.Struct('!I')
+
+
+class Spool(object):
+    ''' Bounded on disk FIFO of strings, memory mapped. Offsets grow forever, positions in the
+        ring are offsets modulo size.
+    '''
+    def __init__(self, path, size=64 << 20):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) > _HEADER.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        if exists:
+            magic, size, _, _ = _HEADER.unpack(os.read(fd, _HEADER.size))
+            if magic != _MAGIC:
+                os.close(fd)
+                raise ValueError('Not a spool', path)
+        else:
+            os.ftruncate(fd, _HEADER.size + size)
+        self.size = size
+        self.mm = mmap.mmap(fd, _HEADER.size + size)
+        os.close(fd)
+        if not exists:
+            self._write_header(0, 0)
+
+    def __repr__(self):
+        return 'Spool(%r, %r)' % (self.path, self.size)
+
+    def _offsets(self):
+        return _HEADER.unpack(self.mm[:_HEADER.size])[2:]
+
+    def _write_header(self, head, tail):
+        self.mm[:_HEADER.size] = _HEADER.pack(_MAGIC, self.size, head, tail)
+
+    def _write(self, offset, data):
+        pos = offset % self.size
+        first = min(len(data), self.size - pos)
+        self.mm[_HEADER.size + pos:_HEADER.size + pos + first] = data[:first]
+        if first < len(data):
+            self.mm[_HEADER.size:_HEADER.size + len(data) - first] = data[first:]
+
+    def _read(self, offset, length):
+        pos = offset % self.size
+        first = min(length, self.size - pos)
+        res = self.mm[_HEADER.size + pos:_HEADER.size + pos + first]
+        if first < length:
+            res += self.mm[_HEADER.size:_HEADER.size + length - first]
+        return res
+
+    @property
+    def used(self):
+        'Bytes in use, including record headers.'
+        head, tail = self._offsets()
+        return tail - head
+
+    def __len__(self):
+        'Number of spooled messages (walks the records).'
+        head, tail = self._offsets()
+        res = 0
+        while head < tail:
+            head += _LEN.size + _LEN.unpack(self._read(head, _LEN.size))[0]
+            res += 1
+        return res
+
+    def holds(self, msg):
+        'Returns True when msg fits in the spool once it is empty.'
+        return _LEN.size + len(msg) <= self.size
+
+    def append(self, msg):
+        'Appends msg. Returns False, without writing, when it does not fit.'
+        head, tail = self._offsets()
+        if tail - head + _LEN.size + len(msg) > self.size:
+            return False
+        self._write(tail, _LEN.pack(len(msg)) + msg)
+        self._write_header(head, tail + _LEN.size + len(msg))
+        return True
+
+    def peek(self):
+        'Returns the oldest message, or None when the spool is empty.'
+        head, tail = self._offsets()
+        if head == tail:
+            return None
+        length = _LEN.unpack(self._read(head, _LEN.size))[0]
+        return self._read(head + _LEN.size, length)
+
+    def pop(self):
+        'Removes and returns the oldest message, or None when the spool is empty.'
+        head, tail = self._offsets()
+        if head == tail:
+            return None
+        length = _LEN.unpack(self._read(head, _LEN.size))[0]
+        res = self._read(head + _LEN.size, length)
+        self._write_header(head + _LEN.size + length, tail)
+        return res
+
+    def flush(self):
+        'Writes the journal to disk (msync), to survive more than a process crash.'
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
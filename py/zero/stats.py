@@ -0,0 +1,196 @@
+''' Per socket counters and timing histograms for Zero, plus a process wide exporter that
+    publishes snapshots of all live Zero objects on a PUB socket.
+
+    Every Zero keeps a ZeroStats in zero.zstats, read it with Zero.stats():
+
+    >>> from zero import Zero, ZeroSetup
+    >>> z = Zero(ZeroSetup('push', 8000))
+    >>> sorted(z.stats())  # doctest: +NORMALIZE_WHITESPACE
+    ['blocked', 'blocked_wait', 'bytes_in', 'bytes_out', 'decode', 'dropped', 'encode',
+     'filtered', 'method', 'msgs_in', 'msgs_out', 'point', 'recv_idle', 'send_wait', 'spooled']
+'''
+import weakref
+from time import time
+from threading import Thread, Lock
+
+__all__ = ('Histogram', 'ZeroStats', 'StatsExporter', 'zstats')
+
+_zeros = weakref.WeakSet()
+_exporter = []
+
+
+class Histogram(object):
+    ''' Log scale histogram of durations in seconds. Bucket n counts samples less than
+        2**n microseconds, so recording is a bit length and an increment.
+
+        >>> h = Histogram()
+        >>> for i in range(100):
+        ...     h.record(i / 1e6)
+        >>> h.count, h.max
+        (100, 9.9e-05)
+        >>> h.percentile(50) <= 64e-6, h.percentile(95) <= 128e-6
+        (True, True)
+        >>> Histogram().percentile(95)
+        0.0
+    '''
+    size = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, secs):
+        'Adds a sample, in seconds.'
+        self.buckets[min(int(secs * 1e6).bit_length(), self.size - 1)] += 1
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+
+    def percentile(self, pct):
+        'Returns the upper bound in seconds of the bucket holding the pct percentile.'
+        if not self.count:
+            return 0.0
+        limit = self.count * pct / 100.0
+        seen = 0
+        for idx, num in enumerate(self.buckets):
+            seen += num
+            if seen >= limit:
+                return min((1 << idx) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        'Returns a json friendly summary.'
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+class ZeroStats(object):
+    ''' Counters and histograms for one Zero. Cheap enough to stay on all the time.
+
+        >>> s = ZeroStats()
+        >>> s.sent(10, 0.001, 0.002)
+        >>> s.received(4, 0.5, 0.001)
+        >>> s.counters['msgs_out'], s.counters['bytes_out'], s.counters['bytes_in']
+        (1, 10, 4)
+        >>> s.timers['recv_idle'].count
+        1
+    '''
+    counter_names = ('msgs_in', 'msgs_out', 'bytes_in', 'bytes_out', 'dropped', 'blocked',
+                     'spooled', 'filtered')
+    timer_names = ('encode', 'decode', 'send_wait', 'recv_idle', 'blocked_wait')
+
+    def __init__(self):
+        self.counters = dict((name, 0) for name in self.counter_names)
+        self.timers = dict((name, Histogram()) for name in self.timer_names)
+
+    def count(self, name, num=1):
+        'Increments (or creates) a counter.'
+        self.counters[name] = self.counters.get(name, 0) + num
+
+    def timer(self, name):
+        'Returns (or creates) a named Histogram.'
+        if name not in self.timers:
+            self.timers[name] = Histogram()
+        return self.timers[name]
+
+    def sent(self, size, encode, wait):
+        'Records one sent message of size bytes.'
+        self.counters['msgs_out'] += 1
+        self.counters['bytes_out'] += size
+        self.timers['encode'].record(encode)
+        self.timers['send_wait'].record(wait)
+
+    def received(self, size, idle, decode):
+        'Records one received message of size bytes.'
+        self.counters['msgs_in'] += 1
+        self.counters['bytes_in'] += size
+        self.timers['recv_idle'].record(idle)
+        self.timers['decode'].record(decode)
+
+    def snapshot(self):
+        'Returns a json friendly dict of all counters and timer summaries.'
+        res = dict(self.counters)
+        for name, hist in self.timers.items():
+            res[name] = hist.snapshot()
+        return res
+
+
+class StatsExporter(object):
+    ''' Publishes snapshots of all live Zero objects in this process every interval seconds.
+        Each published message is [hostname, pid, timestamp, [<Zero.stats()>...]].
+
+        >>> from zero import Zero, ZeroSetup
+        >>> sub = Zero(ZeroSetup('sub', 8001))
+        >>> exp = StatsExporter(ZeroSetup('pub', 8001), interval=0.1).start()
+        >>> host, pid, ts, stats = sub.next()
+        >>> import os; pid == os.getpid()
+        True
+        >>> exp.stop()
+        >>> sub.close()
+    '''
+    def __init__(self, setup, interval=5.0):
+        from zero import Zero
+        self.zero = Zero(setup)
+        _zeros.discard(self.zero)
+        self.interval = interval
+        self._running = False
+        self._thread = None
+
+    def __repr__(self):
+        return 'StatsExporter(%r, %r)' % (self.zero.setup, self.interval)
+
+    def snapshot(self):
+        'Returns the message that is published.'
+        from os import getpid
+        from socket import gethostname
+        return [gethostname(), getpid(), time(), [z.stats() for z in list(_zeros)]]
+
+    def start(self):
+        'Starts publishing in a daemon thread.'
+        self._running = True
+        self._thread = Thread(name='zero stats %r' % self.zero.point, target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        'Stops the publishing thread and closes the socket.'
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.zero.close()
+
+    def _loop(self):
+        from time import sleep
+        while self._running:
+            self.zero(self.snapshot())
+            sleep(self.interval)
+
+
+_lock = Lock()
+
+
+def zstats(setup=None, interval=5.0):
+    ''' Starts the process wide StatsExporter publishing on setup, a pub ZeroSetup or just a
+        port, stopping the one already running. Returns the exporter. With no setup, returns
+        the running exporter or None.
+
+        >>> zstats() is None
+        True
+    '''
+    from zero import ZeroSetup
+    with _lock:
+        if setup is None:
+            return _exporter[0] if _exporter else None
+        if not isinstance(setup, ZeroSetup):
+            setup = ZeroSetup('pub', setup)
+        if _exporter:
+            _exporter[0].stop()
+            del _exporter[:]
+        _exporter.append(StatsExporter(setup, interval).start())
+        return _exporter[0]
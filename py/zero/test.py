@@ -34,3 +34,13 @@ class CommonRPC(ConfiguredRPC):
     def time(self):
         import time
         return time.time()
+
+    def nap(self, secs):
+        import time
+        time.sleep(secs)
+        return secs
+
+    def count(self, n):
+        'Streams 0 to n - 1.'
+        for i in xrange(n):
+            yield i
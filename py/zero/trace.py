@@ -0,0 +1,148 @@
+''' Sampled tracing for Zero and ZeroRPC.
+
+    A traced Zero sends a second frame, the envelope, after the payload:
+    [trace id, span id, send timestamp]. The payload frame is untouched, so the objects that
+    come out of the Zero iterator and sub subscriptions work as before. Any Zero strips the
+    envelope, whether it is traced or not.
+
+    Spans are json objects with the keys trace, span, parent, name, host, start and any of
+    these durations (seconds): queue (send to receive, includes clock skew between hosts),
+    decode, method, encode and roundtrip.
+
+    >>> from zero import Zero, ZeroSetup
+    >>> Zero(ZeroSetup('req', 8000)).traced(Tracer(0.5, '/tmp/spans.json'))
+    Zero(ZeroSetup('req', 8000).binding(False)).traced(Tracer(0.5, '/tmp/spans.json'))
+'''
+import zmq
+import threading
+from json import dumps, loads
+from time import time
+from random import random, getrandbits
+from socket import gethostname
+
+__all__ = ('Tracer', 'current_span')
+
+_local = threading.local()
+
+
+def _new_id():
+    return '%016x' % getrandbits(64)
+
+
+def current_span():
+    'Returns the span being handled by this thread, or None.'
+    return getattr(_local, 'span', None)
+
+
+class Tracer(object):
+    ''' Samples a fraction of the messages sent by traced Zeros (requests that arrive with an
+        envelope are always traced) and writes their spans to collector. The collector is a
+        ZeroSetup for a push socket, or a path to a file that gets one json span per line.
+
+        >>> import os, json, tempfile
+        >>> from zero import Zero, ZeroSetup
+        >>> from zero.rpc import ZeroRPC
+        >>> class Echo(ZeroRPC):
+        ...     def echo(self, msg):
+        ...         return msg
+        >>> path = os.path.join(tempfile.mkdtemp(), 'spans.json')
+        >>> tracer = Tracer(1.0, path)
+        >>> rep = Zero(ZeroSetup('rep', 8002)).activated(Echo()).traced(tracer)
+        >>> from threading import Thread
+        >>> t = Thread(target=lambda: rep(rep.next()))
+        >>> t.start()
+        >>> req = Zero(ZeroSetup('req', 8002)).traced(tracer)
+        >>> req(['echo', {'msg': 'hi'}])
+        u'hi'
+        >>> t.join()
+        >>> tracer.close()
+        >>> spans = [json.loads(line) for line in open(path)]
+        >>> sorted(span['name'] for span in spans)
+        [u'call tcp://localhost:8002', u'echo']
+        >>> spans[0]['trace'] == spans[1]['trace']
+        True
+        >>> sorted(k for k in spans[0] if k not in ('host', 'start'))
+        [u'decode', u'encode', u'method', u'name', u'parent', u'queue', u'span', u'trace']
+        >>> req.close()
+    '''
+    def __init__(self, sample, collector):
+        from Queue import Queue
+        self.sample = sample
+        self.collector = collector
+        self.host = gethostname()
+        self._queue = Queue()
+        self._thread = threading.Thread(name='zero tracer', target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return 'Tracer(%r, %r)' % (self.sample, self.collector)
+
+    def _loop(self):
+        from zero import Zero, ZeroSetup
+        if isinstance(self.collector, ZeroSetup):
+            out = Zero(self.collector)
+            for span in iter(self._queue.get, None):
+                out(span)
+            out.close()
+        else:
+            with open(self.collector, 'a', 1) as fout:
+                for span in iter(self._queue.get, None):
+                    fout.write(dumps(span) + '\n')
+
+    def close(self):
+        'Writes all pending spans and stops the collector thread.'
+        self._queue.put(None)
+        self._thread.join()
+
+    def emit(self, span):
+        'Queues a finished span for the collector.'
+        if _local.__dict__.get('span') is span:
+            del _local.span
+        self._queue.put(span)
+
+    def outgoing(self, zero, encode):
+        ''' Called by Zero.send. Returns an envelope for the message or None when it is not
+            traced.
+        '''
+        span = zero._span
+        if span is not None and zero.setup.replies:
+            zero._span = None
+            span['encode'] = encode
+            self.emit(span)
+            return dumps([span['trace'], span['span'], time()])
+        parent = current_span()
+        if parent is None and random() >= self.sample:
+            return None
+        span = {'trace': parent['trace'] if parent else _new_id(), 'span': _new_id(),
+                'parent': parent['span'] if parent else None, 'host': self.host,
+                'name': 'call ' + zero.point, 'start': time(), 'encode': encode}
+        if zero.setup.method == zmq.REQ:
+            zero._span = span
+        else:
+            self.emit(span)
+        return dumps([span['trace'], span['span'], span['start']])
+
+    def incoming(self, zero, envelope, recvd, decode):
+        ''' Called by Zero.next with the frames after the payload of a received message, when
+            there are any or a call is waiting for its reply.
+        '''
+        span = zero._span
+        if span is not None and zero.setup.method == zmq.REQ:
+            zero._span = None
+            span['roundtrip'] = recvd - span['start']
+            span['decode'] = decode
+            self.emit(span)
+        if not envelope or zero.setup.method == zmq.REQ:
+            return
+        trace, parent, sent = loads(envelope[0])
+        span = {'trace': trace, 'span': _new_id(), 'parent': parent, 'host': self.host,
+                'name': 'handle ' + zero.point, 'start': recvd,
+                'queue': recvd - sent, 'decode': decode}
+        zero._span = _local.span = span
+
+    def handled(self, zero):
+        'Called by Zero.next once a message is handled. Replies finish their span on send.'
+        if zero._span is not None and not zero.setup.transmits:
+            span, zero._span = zero._span, None
+            self.emit(span)
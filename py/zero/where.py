@@ -0,0 +1,270 @@
+''' Filter expressions for received messages, compiled once into a predicate.
+
+    expr  := expr or expr | expr and expr | not expr | ( expr ) | test
+    test  := path | path (== != < <= > >=) value | path in [value, ...] | path ~ "regex"
+    path  := . | name | [index] | path.name | path.index | path[index]
+    value := json literal ("string", 'string', number, true, false, null)
+
+    A path that is not in the message is null; it is never less or greater than anything.
+    < <= > >= take a number or a string, and are false for values of the other kinds.
+    A path by itself is true when it is in the message and not false, 0, "" or empty.
+
+    >>> where = Where('level in ["wtf", "omg"] and not host ~ "^test"')
+    >>> where({'level': 'wtf', 'host': 'alpha'}), where({'level': 'fyi', 'host': 'alpha'})
+    (True, False)
+    >>> zlog = Where('[2] == "omg" or ([0] == "camera" and [4].retries >= 3)')
+    >>> zlog(['camera', 'alpha', 'fyi', '2013-01-01T00:00:00UTC', {'retries': 5}])
+    True
+    >>> zlog(['camera', 'alpha', 'fyi', '2013-01-01T00:00:00UTC', 'no retries'])
+    False
+    >>> Where('. ~ "^al"')('alpha'), Where('missing < 3')({}), Where('missing == null')({})
+    (True, False, True)
+    >>> Where('age >= 18')({'age': 'abc'}), Where('age >= 18')({'age': True})
+    (False, False)
+
+    Before a message is decoded, the test of raw json bytes rejects it when a string that an
+    "and" of == and in tests requires is not in them. true and false are not looked for, as
+    == and in match them with 1 and 0 too:
+
+    >>> where.raw('["fyi", "alpha"]'), where.raw('{"level": "omg", "host": "test"}')
+    (False, True)
+    >>> Where('x == true')({'x': 1}), Where('x == true').raw('{"x": 1}')
+    (True, True)
+    >>> Where('level == "wtf" and')
+    Traceback (most recent call last):
+        ...
+    ValueError: ('Bad filter expression', 'level == "wtf" and', 18)
+'''
+import re
+from json import loads, dumps
+
+__all__ = ('Where',)
+
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<str>"(?:[^"\\]|\\.)*"|'[^']*') |
+    (?P<num>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?) |
+    (?P<op>==|!=|<=|>=|<|>|~) |
+    (?P<punct>[()\[\],.]) |
+    (?P<word>[A-Za-z_][A-Za-z0-9_-]*)
+    )''', re.VERBOSE)
+_KEYWORDS = {'true': True, 'false': False, 'null': None}
+_SAFE = re.compile(r'^[ !#-.0-\[\]-~]*$')  # Strings json encodes as they are (no " \ /)
+_ORDER = {'<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+          '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+
+def _kind(value):
+    'Returns what a range test compares value as: number, string or None for neither.'
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return 'number'
+    if isinstance(value, basestring):
+        return 'string'
+    return None
+
+
+class Where(object):
+    ''' A compiled filter expression. Call with a decoded message for True or False; raw(data)
+        is False when the encoded message can not match.
+    '''
+    def __init__(self, expr):
+        self.expr = expr
+        self._tokens = self._tokenize(expr)
+        self._pos = 0
+        self.test, self._needs = self._or()
+        if self._peek() is not None:
+            self._fail()
+        del self._tokens
+
+    def __repr__(self):
+        return 'Where(%r)' % self.expr
+
+    def __call__(self, obj):
+        return self.test(obj)
+
+    def raw(self, data):
+        'Returns False when json data lacks a string the expression requires.'
+        for needs in self._needs:
+            if not any(need in data for need in needs):
+                return False
+        return True
+
+    def _fail(self):
+        pos = self._tokens[self._pos][0] if self._pos < len(self._tokens) else len(self.expr)
+        raise ValueError('Bad filter expression', self.expr, pos)
+
+    def _tokenize(self, expr):
+        res = []
+        pos = 0
+        while expr[pos:].strip():
+            match = _TOKEN.match(expr, pos)
+            if not match:
+                raise ValueError('Bad filter expression', expr, pos)
+            kind = match.lastgroup
+            res.append((match.start(kind), kind, match.group(kind)))
+            pos = match.end()
+        return res
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos][2]
+        return None
+
+    def _take(self, kind=None, text=None):
+        if self._pos >= len(self._tokens):
+            self._fail()
+        _, tkind, ttext = self._tokens[self._pos]
+        if (kind and tkind != kind) or (text and ttext != text):
+            self._fail()
+        self._pos += 1
+        return ttext
+
+    # Each of these returns (predicate, needs), where needs is a list of sets of strings of
+    # which raw json must contain at least one each.
+
+    def _or(self):
+        test, needs = self._and()
+        while self._peek() == 'or':
+            self._take()
+            other, _ = self._and()
+            test = (lambda a, b: lambda obj: a(obj) or b(obj))(test, other)
+            needs = []
+        return test, needs
+
+    def _and(self):
+        test, needs = self._not()
+        while self._peek() == 'and':
+            self._take()
+            other, more = self._not()
+            test = (lambda a, b: lambda obj: a(obj) and b(obj))(test, other)
+            needs = needs + more
+        return test, needs
+
+    def _not(self):
+        if self._peek() == 'not':
+            self._take()
+            test, _ = self._not()
+            return (lambda obj: not test(obj)), []
+        if self._peek() == '(':
+            self._take()
+            res = self._or()
+            self._take('punct', ')')
+            return res
+        return self._test()
+
+    def _test(self):
+        path = self._path()
+        op = self._peek()
+        if op not in _ORDER and op not in ('==', '!=', '~', 'in'):
+            return (lambda obj: bool(path(obj))), []
+        self._take()
+        if op == 'in':
+            values = self._list()
+            return (lambda obj: path(obj) in values), self._encoded(values)
+        value = self._value()
+        if op == '==':
+            return (lambda obj: path(obj) == value), self._encoded([value])
+        if op == '!=':
+            return (lambda obj: path(obj) != value), []
+        if op == '~':
+            if not isinstance(value, basestring):
+                self._fail()
+            search = re.compile(value).search
+            return (lambda obj: isinstance(path(obj), basestring) and
+                    search(path(obj)) is not None), []
+        compare = _ORDER[op]
+        kind = _kind(value)
+        if kind is None:
+            self._fail()
+
+        def order(obj):
+            found = path(obj)
+            return _kind(found) == kind and compare(found, value)
+        return order, []
+
+    @staticmethod
+    def _encoded(values):
+        ''' Returns needs for a test that matches one of values: their json encodings, or
+            nothing when one of them can not be looked for in raw json.
+        '''
+        res = set()
+        for value in values:
+            if not isinstance(value, basestring) or not _SAFE.match(value):
+                return []
+            res.add(dumps(value))
+        return [res]
+
+    def _at(self, kind):
+        return self._pos < len(self._tokens) and self._tokens[self._pos][1] == kind
+
+    def _path(self):
+        steps = []
+        dot = self._peek() == '.'
+        if dot:
+            self._take()
+        while True:
+            if self._peek() == '[':
+                steps.append(self._index())
+            elif self._at('word') and (dot or not steps):
+                steps.append(self._name())
+            elif self._at('num') and dot and steps:
+                steps.append(int(self._take()))
+            elif dot and not steps:
+                break  # The message itself
+            else:
+                self._fail()
+            dot = self._peek() == '.'
+            if dot:
+                self._take()
+            elif self._peek() != '[':
+                break
+        return self._steps(steps)
+
+    def _name(self):
+        name = self._take('word')
+        if name in ('and', 'or', 'not', 'in'):
+            self._pos -= 1
+            self._fail()
+        return name
+
+    def _index(self):
+        self._take('punct', '[')
+        res = int(self._take('num'))
+        self._take('punct', ']')
+        return res
+
+    @staticmethod
+    def _steps(steps):
+        def path(obj):
+            for step in steps:
+                if isinstance(step, int):
+                    if not isinstance(obj, list) or not -len(obj) <= step < len(obj):
+                        return None
+                elif not isinstance(obj, dict) or step not in obj:
+                    return None
+                obj = obj[step]
+            return obj
+        return path
+
+    def _list(self):
+        self._take('punct', '[')
+        res = [self._value()]
+        while self._peek() == ',':
+            self._take()
+            res.append(self._value())
+        self._take('punct', ']')
+        return res
+
+    def _value(self):
+        if self._pos >= len(self._tokens):
+            self._fail()
+        kind, text = self._tokens[self._pos][1:]
+        if kind == 'str':
+            self._pos += 1
+            return loads(text) if text[0] == '"' else text[1:-1]
+        if kind == 'num':
+            self._pos += 1
+            return loads(text)
+        if kind == 'word' and text in _KEYWORDS:
+            self._pos += 1
+            return _KEYWORDS[text]
+        self._fail()
@@ -8,6 +8,9 @@
       zlog-sink [<config>]
 
     <config>  Path to configuration file [default: log.json]
+
+    With a "control" port in the config, level commands from zlog level are published there
+    for the running loggers.
 '''
 
 from ansicolor import *
@@ -60,6 +63,7 @@ def main():
     from sys import argv
     from json import load
     from zero import Zero, ZeroSetup
+    from zero.compress import Compressor
     HERE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
     conf = HERE + '/log.json'
     if len(argv) > 1:
@@ -71,12 +75,23 @@ def main():
     path = conf['file']
     if path[0] != '/':
         path = HERE + '/' + path
+    ctl = None
+    if 'control' in conf:
+        ctl = Zero(ZeroSetup('pub', conf['control']))
+        _ = ctl.sock  # Bound for as long as the sink runs, loggers stay connected
+        ctl.naptime = 0
     print 'Logger started for', setup
     print 'Logging to', path
     with open(path, 'a', 1) as fout:
         logout = Logout(conf)
         try:
-            for line in Zero(setup):
+            for line in Zero(setup).compressing(Compressor.from_config(conf.get('compress'))):
+                if isinstance(line, list):
+                    # Not a log line but a command, ['level', <sender>, <level>]
+                    if ctl and len(line) == 3 and line[0] == 'level':
+                        print 'Level of %s set to %s' % tuple(line[1:])
+                        ctl(line)
+                    continue
                 fout.write(line)
                 fout.write('\n')
                 logout.tty(line)
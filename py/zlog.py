@@ -6,32 +6,74 @@
 
 ''' USAGE:
       zlog [<config>] (lol|fyi|wtf|omg) <sender> (-|<message> <message>...)
+      zlog [<config>] level <sender> <level>
 
     <sender> is a logical name of emitting party.
 
     If <message> is -, message lines are read from stdin.
+
+    level sets the minimum level logged by running loggers of <sender> (* for all senders).
+    Lower levels are not even formatted. The command goes to zlog-sink, which publishes it on
+    the "control" port of the config, so both need one. Loggers started later, or not
+    connected to the sink at the time, keep the level from the config.
 '''
 
 __all__ = ('ZLogger', 'zlogger')
 from socket import gethostname
 from zero import ZeroSetup, Zero
+from zero.compress import Compressor
+
+
+def _noop(msg):
+    'Stands in for the methods of levels below the minimum.'
 
 
 class ZLogger(object):
-    'ZMQ logging object. Caches host and sender. Transmits via a queue to the push Zero.'
+    ''' ZMQ logging object. Caches host and sender. Transmits via a queue to the push Zero.
+        Levels are ordered as in config['levels']; those below the minimum level of the sender
+        (config['min-levels'][sender], or ['*']) are not logged.
+
+        >>> from Queue import Queue
+        >>> config = {'levels': [['lol', 'dim'], ['fyi', 'grn'], ['wtf', 'yel']],
+        ...           'min-levels': {'*': 'fyi'}}
+        >>> log = ZLogger(config, Queue(), 'camera', 'alpha')
+        >>> log.lol('Not formatted'), log.fyi('Queued'), log.logq.qsize()
+        (None, None, 1)
+        >>> log.setlevel('lol')
+        >>> log.lol('Queued'), log.logq.qsize()
+        (None, 2)
+        >>> log.setlevel('omg')
+        Traceback (most recent call last):
+            ...
+        ValueError: ('Unknown level', 'omg')
+    '''
     def __init__(self, config, logq, sender, host):
         self.logq = logq
         self.sender = sender
         self.host = host
-        for lvl, _ in config['levels']:
+        self.levels = [lvl for lvl, _ in config['levels']]
+        minimum = config.get('min-levels', {})
+        self.setlevel(minimum.get(sender, minimum.get('*')))
+
+    def setlevel(self, level):
+        ''' Sets the minimum level logged, None for all. Methods of lower levels become no-ops:
+            nothing is formatted or queued.
+        '''
+        if level is not None and level not in self.levels:
+            raise ValueError('Unknown level', level)
+        self.level = level
+        rank = self.levels.index(level) if level else 0
+        self._disabled = set(self.levels[:rank])
+        for lvl in self.levels:
             def logout(msg, lvl=lvl):
                 'Local function object for dynamic log level functions such as fyi or wtf.'
                 self.log(msg, lvl)
-            setattr(self, lvl, logout)
+            setattr(self, lvl, _noop if lvl in self._disabled else logout)
 
     def log(self, msg, level):
-        'Formats a message and puts it on the logging queue.'
-        self.logq.put(self.format(self.sender, level, msg, self.host))
+        'Formats a message and puts it on the logging queue, unless level is disabled.'
+        if level not in self._disabled:
+            self.logq.put(self.format(self.sender, level, msg, self.host))
 
     @classmethod
     def format(cls, sender, level, msg, host=gethostname(), ts_format='%Y-%m-%dT%H:%M:%S%Z'):
@@ -44,11 +86,16 @@ class ZLogger(object):
 def zlogger(config, sender):
     ''' Convenience function for setting up a ZLogger and queue. Returns a ZLogger
         object with .fyi, .wtf, .omg functions as specified in config['log']['levels'].
+        Messages are compressed when config has a "compress" node, see zero.compress.
+        When config has a "control" port, the minimum level can be changed at runtime with
+        zlog level (see __doc__), through zlog-sink on config["host"].
     '''
+    from json import dumps
     from Queue import Queue
     from threading import Thread
     logq = Queue()
     slog = Zero(ZeroSetup('push', 'tcp://%(host)s:%(port)s' % config).nonblocking())
+    slog.compressing(Compressor.from_config(config.get('compress')))
 
     def thread(slog=slog):
         for t in iter(logq.get, ''):
@@ -56,7 +103,24 @@ def zlogger(config, sender):
     t = Thread(target=thread)
     t.daemon = True
     t.start()
-    return ZLogger(config, logq, sender, gethostname())
+    logger = ZLogger(config, logq, sender, gethostname())
+    if 'control' in config:
+        # Only level commands for this sender or for all senders get through the socket
+        subscriptions = [dumps(['level', name])[:-1] + ',' for name in (sender, '*')]
+        ctl = Zero(ZeroSetup('sub', 'tcp://%s:%s' % (config['host'], config['control']))
+                   .subscribing(subscriptions))
+
+        def control(ctl=ctl):
+            while True:
+                try:
+                    _, _, level = ctl.next()
+                    logger.setlevel(level)
+                except (ValueError, TypeError), e:
+                    ctl.setup.warn('Ignoring control message for %s: %s', sender, e)
+        t = Thread(target=control)
+        t.daemon = True
+        t.start()
+    return logger
 
 
 def main():
@@ -79,12 +143,26 @@ def main():
     with open(conf) as fin:
         conf = load(fin)['log']
     sender = args.popleft()
+    if level == 'level':
+        if 'control' not in conf:
+            exit(__doc__)
+        z = Zero(ZeroSetup('push', 'tcp://%(host)s:%(port)s' % conf))
+        z.compressing(Compressor.from_config(conf.get('compress')))
+        z(['level', sender, args[0]])
+        z.close()
+        return
     if args[0] == '-':
         messages = ZeroSetup.iter_stdin()
     else:
         messages = iter(args)
     messages = imap(lambda x: ZLogger.format(sender, level, x), messages)
-    z = Zero(ZeroSetup('push', conf['port']))
+    setup = ZeroSetup('push', conf['port'])
+    compressor = Compressor.from_config(conf.get('compress'))
+    if args[0] != '-' and not compressor:  # The agent sends uncompressed
+        from zero.agent import zhandoff
+        if zhandoff(setup, messages) is not None:
+            return
+    z = Zero(setup).compressing(compressor)
     for msg in messages:
         z(msg)
 